@@ -1,11 +1,17 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, Response, stream_with_context
 import uuid
 from celery_app import celery
-from fonctions import set_task_status, upload_to_blob_storage, create_video_with_scenes, logger
+from fonctions import set_task_status, upload_to_blob_storage, create_video_with_scenes, download_video, io_executor, synthesize_speech, publish_progress, logger, RENDER_BACKEND, fail_softly
+from subtitles import add_subtitle_track, SubtitleTrack
+from ffmpeg_render import encode_still_segment
+from workspace import task_workspace, scene_workspace
+from llm_cache import cached_completion, story_event_stream, OPENAI_TIMEOUT, OPENAI_MAX_RETRIES
+from render import SCENE_FANOUT, SEGMENT_ASSEMBLY, submit_render, check_render_attempts, warm_assets, render_scenes_in_parallel, render_and_upload_segment, render_video_from_segments, write_clip_segment
 import traceback
-import requests
 import logging
 from moviepy.editor import *
+from PIL import Image
+import numpy as np
 from prompts.animation import PROMPT_SYSTEM_ANIMATION, PROMPT_USER1, PROMPT_USER2, ANIMATION_VOICE_ID_DEFAULT,ANIMATION_VOICE_ID_EN, ANIMATION_VOICE_ID_ES, ANIMATION_VOICE_ID_FR, CHUNK_SIZE
 from openai import OpenAI
 from pydantic import BaseModel
@@ -19,7 +25,12 @@ api_key = os.getenv('OPENAI_API_KEY')
 eleven_labs_api_key = os.getenv("ELEVENLABS_API_KEY")
 replicate_api_token = os.getenv("REPLICATE_API_TOKEN")
 
-client = OpenAI(api_key=api_key)
+client = OpenAI(api_key=api_key, timeout=OPENAI_TIMEOUT, max_retries=OPENAI_MAX_RETRIES)
+
+# Name of this pipeline in the render deduplication and segment cache keys
+PIPELINE = "animated"
+# Whether the background music is mixed under the voice
+BACKGROUND_MUSIC = "false"
 
 class Scene(BaseModel):
    sentences: str
@@ -29,32 +40,45 @@ class Story(BaseModel):
     scenes: List[Scene]
     complete_story: str
 
+def story_messages(topic, language):
+    return [
+        {"role": "system", "content": PROMPT_SYSTEM_ANIMATION},
+        {"role": "user", "content": PROMPT_USER1 + topic},
+        {"role": "user", "content": PROMPT_USER2 + language}
+    ]
+
 @animated_story.route('/get_story', methods=['GET'])
+@fail_softly("Failed to generate story")
 def generate_story():
     topic = request.args.get('topic')
     language = request.args.get('language')
     if topic and language:
-        try:
-            completion = client.beta.chat.completions.parse(
-            #model="gpt-4o-2024-08-06",
-            model = "gpt-4o-mini",
-            
-            messages=[
-                {"role": "system", "content": PROMPT_SYSTEM_ANIMATION},
-                {"role": "user", "content": PROMPT_USER1 + topic},
-                {"role": "user", "content": PROMPT_USER2 +language}
-            ],
-            response_format=Story,
-            )
-            response = completion.choices[0].message.parsed
-            response_dict = response.model_dump()
-            return jsonify(response_dict)
-        except Exception as e:
-            print(f"Failed to generate story: {e}")
-            return None
+        response = cached_completion(
+        client,
+        #model="gpt-4o-2024-08-06",
+        model = "gpt-4o-mini",
+        
+        messages=story_messages(topic, language),
+        response_format=Story,
+        )
+        response_dict = response.model_dump()
+        return jsonify(response_dict)
     else:
         return jsonify({'error': 'No topic provided'}), 400
 
+@animated_story.route('/get_story_stream', methods=['GET'])
+def generate_story_stream():
+    # Same story as /get_story, sent as Server-Sent Events: one "scene" event per scene
+    # as soon as it is generated, then the full "story"
+    topic = request.args.get('topic')
+    language = request.args.get('language')
+    if not (topic and language):
+        return jsonify({'error': 'No topic provided'}), 400
+
+    events = story_event_stream(client, model="gpt-4o-mini", messages=story_messages(topic, language), response_format=Story)
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(stream_with_context(events), mimetype="text/event-stream", headers=headers)
+
 @animated_story.route('/video_animated_editor', methods=['POST'])
 def animated_video_editor():
     scene_data = request.json.get('scene_data')
@@ -62,30 +86,48 @@ def animated_video_editor():
     if not scene_data:
         return jsonify({"error": "No scene data provided"}), 400
     
-    task_id = str(uuid.uuid4())
-    set_task_status(task_id, "processing")
-
-    # Start the video generation process as a Celery task
-    generate_animated_video_in_background_celery.apply_async(args=[task_id, scene_data])
+    # Start the video generation process as a Celery task, unless the same video
+    # is already rendered or rendering
+    task_id, video_url = submit_render(PIPELINE, warm_animated_assets_celery, generate_animated_video_in_background_celery, scene_data, BACKGROUND_MUSIC)
+    if video_url:
+        return jsonify({"task_id": task_id, "video_url": video_url}), 200
 
     return jsonify({"task_id": task_id}), 202
 
 @celery.task(name="animated_video_task")
 def generate_animated_video_in_background_celery(task_id, scenes_data):
     try:
-        output_path = f"final_video_{uuid.uuid4()}.mp4"
-        scenes = []
-        logger.debug("Generate_animated_video_in_background....")
-
-        for scene_data in scenes_data:
-            image_path = scene_data[0]
-            #audio_path = scene_data[1]
-            text = scene_data[1]
-            scenes.append(create_animated_scene(image_path, "Spanish", text))
-        
-        music = "false"
-        create_video_with_scenes(scenes, output_path, music)
-        video_url = upload_to_blob_storage(output_path, "video")
+        if not check_render_attempts(task_id):
+            return
+
+        if SCENE_FANOUT:
+            scene_tasks = [render_animated_scene_celery.s(scene_data, "Spanish", task_id, len(scenes_data)) for scene_data in scenes_data]
+            render_scenes_in_parallel(task_id, scene_tasks, BACKGROUND_MUSIC)
+            return
+
+        # Every file of this render lives in its own scratch directory
+        with task_workspace(task_id) as workdir:
+            scenes = []
+            logger.debug("Generate_animated_video_in_background....")
+
+            music = BACKGROUND_MUSIC
+            if SEGMENT_ASSEMBLY:
+                # Only the scenes missing from the segment cache are fetched and rendered
+                video_url = render_video_from_segments(task_id, PIPELINE, scenes_data, prefetch_animated_assets, render_animated_segment, "Spanish", music, workdir)
+            else:
+                # Start the TTS and image downloads of every scene at once
+                scenes_assets = prefetch_animated_assets(scenes_data, "Spanish", workdir)
+                publish_progress(task_id, "assets", 20)
+
+                output_path = os.path.join(workdir, f"final_video_{uuid.uuid4()}.mp4")
+                for scene_data, assets in zip(scenes_data, scenes_assets):
+                    image_path = scene_data[0]
+                    #audio_path = scene_data[1]
+                    text = scene_data[1]
+                    scenes.append(create_animated_scene(image_path, "Spanish", text, assets=assets))
+                publish_progress(task_id, "encoding", 30)
+                create_video_with_scenes(scenes, output_path, music)
+                video_url = upload_to_blob_storage(output_path, "video")
 
         # Update task status to completed
         set_task_status(task_id, "completed", video_url=video_url)
@@ -95,11 +137,78 @@ def generate_animated_video_in_background_celery(task_id, scenes_data):
         logger.error(f"Error in generate_video_in_background: {traceback.format_exc()}")
         set_task_status(task_id, "failed", error=str(e))
 
-def create_animated_scene(image_path, language, text, duration=None):
+@celery.task(name="animated_assets_task")
+def warm_animated_assets_celery(scenes_data, language):
+    warm_assets(PIPELINE, prefetch_animated_audio, scenes_data, language)
+
+@celery.task(name="animated_scene_task")
+def render_animated_scene_celery(scene_data, language, task_id, scenes_total):
+    return render_and_upload_segment(PIPELINE, render_animated_segment, scene_data, language, task_id, scenes_total)
+
+def render_animated_segment(scene_data, language, segment_path, assets=None):
+    image_path = scene_data[0]
+    text = scene_data[1]
+    if assets is None:
+        assets = prefetch_animated_assets([scene_data], language, os.path.dirname(segment_path))[0]
+    if RENDER_BACKEND != "ffmpeg":
+        return write_clip_segment(create_animated_scene(image_path, language, text, assets=assets), segment_path)
+
+    # Still-image fast path: the background never changes, so only one frame per
+    # subtitle is blended and ffmpeg holds it for the phrase duration
+    if assets["image"]:
+        image_path = assets["image"]
+
+    audio_clip = AudioFileClip(assets["audio"])
+    duration = audio_clip.duration
+    audio_clip.close()
+
+    background = np.asarray(Image.open(image_path).convert("RGB"))
+    track = SubtitleTrack(animated_subtitle_timings(text, duration), fontsize=40, color='white')
+    encode_still_segment(track.still_frames(background, duration), assets["audio"], duration, segment_path)
+
+    os.remove(assets["audio"])
+    if assets["image"]:
+        os.remove(assets["image"])
+    return segment_path
+
+def animated_subtitle_timings(text, duration):
+    # Create word-by-word subtitles
+    words = text.split()
+    phrase_length = 1  # Number of words per phrase (adjust as needed)
+    phrases = [" ".join(words[i:i + phrase_length]) for i in range(0, len(words), phrase_length)]
+    phrase_duration = duration / len(phrases)  # Set duration for each phrase to appear
+    return [(i * phrase_duration, (i + 1) * phrase_duration, phrase) for i, phrase in enumerate(phrases)]
+
+def prefetch_animated_assets(scenes_data, language, workdir):
+    # The TTS request and the image download of every scene run concurrently
+    scene_dirs = [scene_workspace(workdir, i) for i in range(len(scenes_data))]
+    audio_futures = [io_executor.submit(generate_audio_scene, scene_data[1], language, scene_dir) for scene_data, scene_dir in zip(scenes_data, scene_dirs)]
+    image_futures = []
+    for scene_data, scene_dir in zip(scenes_data, scene_dirs):
+        image_path = scene_data[0]
+        if image_path.startswith("http"):
+            image_futures.append(io_executor.submit(download_video, image_path, os.path.join(scene_dir, f"image_{uuid.uuid4()}.jpg")))
+        else:
+            image_futures.append(None)
+
+    return [{"audio": audio_future.result(), "image": image_future.result() if image_future else None}
+            for audio_future, image_future in zip(audio_futures, image_futures)]
+
+def prefetch_animated_audio(scenes_data, language, workdir):
+    # Image URLs are unique to each story, only the speech is worth caching ahead
+    scene_dirs = [scene_workspace(workdir, i) for i in range(len(scenes_data))]
+    audio_futures = [io_executor.submit(generate_audio_scene, scene_data[1], language, scene_dir) for scene_data, scene_dir in zip(scenes_data, scene_dirs)]
+    return [audio_future.result() for audio_future in audio_futures]
+
+def create_animated_scene(image_path, language, text, duration=None, assets=None):
     logger.debug("create animated scene...")
     size = (1280, 720)
 
-    file_name = generate_audio_scene(text, language)
+    if assets is None:
+        assets = prefetch_animated_assets([[image_path, text]], language, "audios")[0]
+    file_name = assets["audio"]
+    if assets["image"]:
+        image_path = assets["image"]
 
     image_clip = ImageClip(image_path).set_fps(10)  # Lower FPS for optimization
 
@@ -117,32 +226,21 @@ def create_animated_scene(image_path, language, text, duration=None):
     # Set the duration of the image clip
     image_clip = image_clip.set_duration(duration)
 
-    # Create word-by-word TextClips
-    words = text.split()
-    phrase_length = 1  # Number of words per phrase (adjust as needed)
-    phrases = [" ".join(words[i:i + phrase_length]) for i in range(0, len(words), phrase_length)]
-    phrase_duration = duration / len(phrases)  # Set duration for each phrase to appear
-
-    # Create TextClips for each phrase and arrange them in sequence
-    phrase_clips = []
-    for i, phrase in enumerate(phrases):
-        try:
-            phrase_clip = TextClip(phrase, fontsize=40, color='white', font='DejaVu-Sans-Bold')
-            phrase_clip = phrase_clip.set_position(('center', 'center')).set_duration(phrase_duration)
-            phrase_clip = phrase_clip.set_start(i * phrase_duration)  # Set when each phrase appears
-            phrase_clips.append(phrase_clip)
-        except Exception as e:
-            logger.debug(f"Failed to create TextClip for phrase '{phrase}'. Error: {str(e)}")
-            raise Exception(f"Failed to create TextClip for phrase '{phrase}'. Error: {str(e)}")
-        
-    # Overlay the phrases on top of the image using CompositeVideoClip
-    video_clip_with_text = CompositeVideoClip([image_clip] + phrase_clips).set_audio(audio_clip)
+    # One subtitle track that only draws the phrase active at each frame
+    timings = animated_subtitle_timings(text, duration)
+    try:
+        video_clip_with_text = add_subtitle_track(image_clip, timings, fontsize=40, color='white').set_audio(audio_clip)
+    except Exception as e:
+        logger.debug(f"Failed to create subtitles. Error: {str(e)}")
+        raise Exception(f"Failed to create subtitles. Error: {str(e)}")
 
     # Set the audio for the image clip
     #image_clip = image_clip.set_audio(audio_clip)
 
     # Clean up local file after upload
     os.remove(file_name)
+    if assets["image"]:
+        os.remove(assets["image"])
 
     # Set the audio for the video clip
     video_clip_with_text = video_clip_with_text.set_audio(audio_clip)
@@ -151,40 +249,20 @@ def create_animated_scene(image_path, language, text, duration=None):
     return video_clip_with_text
 
 
-def generate_audio_scene(text, language):
+def generate_audio_scene(text, language, workdir="audios"):
     logger.debug("generate_audio_scene...")
     if language == "Spanish":
-        url = f"https://api.elevenlabs.io/v1/text-to-speech/{ANIMATION_VOICE_ID_ES}"
+        voice_id = ANIMATION_VOICE_ID_ES
     if language == "French":
-        url = f"https://api.elevenlabs.io/v1/text-to-speech/{ANIMATION_VOICE_ID_FR}"
+        voice_id = ANIMATION_VOICE_ID_FR
     if language == "English":
-        url = f"https://api.elevenlabs.io/v1/text-to-speech/{ANIMATION_VOICE_ID_EN}"
+        voice_id = ANIMATION_VOICE_ID_EN
     else:
-        url = f"https://api.elevenlabs.io/v1/text-to-speech/{ANIMATION_VOICE_ID_ES}"  
+        voice_id = ANIMATION_VOICE_ID_ES  
     
-    headers = {
-        "Accept": "audio/mpeg",
-        "Content-Type": "application/json",
-        "xi-api-key": eleven_labs_api_key
-    }
-    data = {
-        "text": text,
-        "model_id": "eleven_turbo_v2_5",
-        "voice_settings": {
-        "stability": 0.5,
-        "similarity_boost": 0.5
-        }
-    }
     try:
-        response = requests.post(url, json=data, headers=headers)
-        response.raise_for_status()
-        temp_file_name = "audios/audio.mp3"
-        with open(temp_file_name, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
-                if chunk:
-                    f.write(chunk)
-
-        return temp_file_name
+        temp_file_name = os.path.join(workdir, f"audio_{uuid.uuid4()}.mp3")
+        return synthesize_speech(text, voice_id, temp_file_name)
         
     except Exception as e:
         print(f"Error generating audio: {e}")
@@ -1,4 +1,4 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, Response, stream_with_context
 from prompts.commercial import *
 from openai import OpenAI
 from pydantic import BaseModel
@@ -9,7 +9,11 @@ from celery_app import celery
 import requests
 import logging
 import traceback
-from fonctions import set_task_status, upload_to_blob_storage, create_video_with_scenes, search_for_stock_videos, download_video, logger
+from fonctions import set_task_status, upload_to_blob_storage, create_video_with_scenes, fetch_stock_videos, pick_stock_video, download_stock_clip, normalize_stock_clip, release_clip_links, io_executor, synthesize_speech, publish_progress, logger, RENDER_BACKEND, fail_softly
+from ffmpeg_render import mux_scene_segment
+from workspace import task_workspace, scene_workspace
+from llm_cache import cached_completion, story_event_stream, OPENAI_TIMEOUT, OPENAI_MAX_RETRIES
+from render import SCENE_FANOUT, SEGMENT_ASSEMBLY, submit_render, check_render_attempts, warm_assets, render_scenes_in_parallel, render_and_upload_segment, render_video_from_segments, write_clip_segment
 from moviepy.editor import *
 import uuid
 
@@ -19,7 +23,14 @@ api_key = os.getenv('OPENAI_API_KEY')
 eleven_labs_api_key = os.getenv("ELEVENLABS_API_KEY")
 replicate_api_token = os.getenv("REPLICATE_API_TOKEN")
 
-client = OpenAI(api_key=api_key)
+client = OpenAI(api_key=api_key, timeout=OPENAI_TIMEOUT, max_retries=OPENAI_MAX_RETRIES)
+
+# Name of this pipeline in the render deduplication and segment cache keys
+PIPELINE = "commercial"
+# Whether the background music is mixed under the voice
+BACKGROUND_MUSIC = "true"
+
+COMMERCIAL_SCENE_SIZE = (1080, 720)
 
 class Webinfo(BaseModel):
    webinfo: str
@@ -35,37 +46,50 @@ class Story(BaseModel):
     webinfo: str
 
 
+def story_messages(url, language):
+    return [
+        {"role": "system", "content": PROMPT_SYSTEM_WEBINFO},
+        {"role": "user", "content": PROMPT_URL + url},
+        {"role": "system", "content": PROMPT_SYSTEM_COMMERCIAL},
+        #{"role": "user", "content": PROMPT_USER1 + topic},
+        {"role": "user", "content": PROMPT_USER2 + language}
+    ]
+
 @video_commercial.route('/get_commercial', methods=['GET'])
+@fail_softly("Failed to generate commercial script")
 def generate_story():
     #topic = request.args.get('topic')
     url = request.args.get('url')
     language = request.args.get('language')
     
     if url and language:
-        try:
-            completion = client.beta.chat.completions.parse(
-            #model="gpt-4o-2024-08-06",
-            model = "gpt-4o-mini",
-            
-            messages=[
-                {"role": "system", "content": PROMPT_SYSTEM_WEBINFO},
-                {"role": "user", "content": PROMPT_URL + url},
-                {"role": "system", "content": PROMPT_SYSTEM_COMMERCIAL},
-                #{"role": "user", "content": PROMPT_USER1 + topic},
-                {"role": "user", "content": PROMPT_USER2 +language}
-            ],
-            response_format=Story,
-            )
-            response = completion.choices[0].message.parsed
-            response_dict = response.model_dump()
-            return jsonify(response_dict)
-        except Exception as e:
-            print(f"Failed to generate commercial script: {e}")
-            return None
+        response = cached_completion(
+        client,
+        #model="gpt-4o-2024-08-06",
+        model = "gpt-4o-mini",
+        
+        messages=story_messages(url, language),
+        response_format=Story,
+        )
+        response_dict = response.model_dump()
+        return jsonify(response_dict)
     else:
         return jsonify({'error': 'No topic provided'}), 400
 
 
+@video_commercial.route('/get_commercial_stream', methods=['GET'])
+def generate_story_stream():
+    # Same story as /get_commercial, sent as Server-Sent Events: one "scene" event per scene
+    # as soon as it is generated, then the full "story"
+    url = request.args.get('url')
+    language = request.args.get('language')
+    if not (url and language):
+        return jsonify({'error': 'No url provided'}), 400
+
+    events = story_event_stream(client, model="gpt-4o-mini", messages=story_messages(url, language), response_format=Story)
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(stream_with_context(events), mimetype="text/event-stream", headers=headers)
+
 @video_commercial.route('/commercial_video_editor', methods=['POST'])
 def motivation_video_editor():
     scene_data = request.json.get('scene_data')
@@ -73,28 +97,51 @@ def motivation_video_editor():
     if not scene_data:
         return jsonify({"error": "No scene data provided"}), 400
     
-    task_id = str(uuid.uuid4())
-
-    # Start the video generation process as a Celery task
-    generate_commercial_video_in_background_celery.apply_async(args=[task_id, scene_data])
+    # Start the video generation process as a Celery task, unless the same video
+    # is already rendered or rendering
+    task_id, video_url = submit_render(PIPELINE, warm_commercial_assets_celery, generate_commercial_video_in_background_celery, scene_data, BACKGROUND_MUSIC)
+    if video_url:
+        return jsonify({"task_id": task_id, "video_url": video_url}), 200
 
     return jsonify({"task_id": task_id}), 202
 
 @celery.task(name="commercial_video_task")
 def generate_commercial_video_in_background_celery(task_id, scenes_data):
     try:
-        output_path = f"final_video_{uuid.uuid4()}.mp4"
-        scenes = []
-        logger.debug("Generate_commercial_video_in_background....")
+        if not check_render_attempts(task_id):
+            return
+
+        if SCENE_FANOUT:
+            scene_tasks = [render_commercial_scene_celery.s(scene_data, "Spanish", task_id, len(scenes_data)) for scene_data in scenes_data]
+            render_scenes_in_parallel(task_id, scene_tasks, BACKGROUND_MUSIC)
+            return
 
-        for scene_data in scenes_data:
-            prompt_video = scene_data[0]
-            text = scene_data[1]
-            scenes.append(create_commercial_scene(prompt_video, "Spanish", text))
+        # Every file of this render lives in its own scratch directory
+        with task_workspace(task_id) as workdir:
+            scenes = []
+            logger.debug("Generate_commercial_video_in_background....")
 
-        music = "true"
-        create_video_with_scenes(scenes, output_path, music)
-        video_url = upload_to_blob_storage(output_path, "video")
+            music = BACKGROUND_MUSIC
+            if SEGMENT_ASSEMBLY:
+                # Only the scenes missing from the segment cache are fetched and rendered
+                video_url = render_video_from_segments(task_id, PIPELINE, scenes_data, prefetch_commercial_assets, render_commercial_segment, "Spanish", music, workdir)
+            else:
+                # Start the TTS and Pexels requests of every scene at once
+                scenes_assets = prefetch_commercial_assets(scenes_data, "Spanish", workdir)
+                publish_progress(task_id, "assets", 20)
+
+                output_path = os.path.join(workdir, f"final_video_{uuid.uuid4()}.mp4")
+                for scene_data, assets in zip(scenes_data, scenes_assets):
+                    prompt_video = scene_data[0]
+                    text = scene_data[1]
+                    scenes.append(create_commercial_scene(prompt_video, "Spanish", text, assets=assets))
+                publish_progress(task_id, "encoding", 30)
+                try:
+                    create_video_with_scenes(scenes, output_path, music)
+                finally:
+                    for assets in scenes_assets:
+                        release_clip_links(assets)
+                video_url = upload_to_blob_storage(output_path, "video")
 
         # Update task status to completed
         set_task_status(task_id, "completed", video_url=video_url)
@@ -104,11 +151,69 @@ def generate_commercial_video_in_background_celery(task_id, scenes_data):
         logger.error(f"Error in generate_video_in_background: {traceback.format_exc()}")
         set_task_status(task_id, "failed", error=str(e))
 
-def create_commercial_scene(prompt_video, language, text, duration=None):
+@celery.task(name="commercial_assets_task")
+def warm_commercial_assets_celery(scenes_data, language):
+    warm_assets(PIPELINE, prefetch_commercial_assets, scenes_data, language)
+
+@celery.task(name="commercial_scene_task")
+def render_commercial_scene_celery(scene_data, language, task_id, scenes_total):
+    return render_and_upload_segment(PIPELINE, render_commercial_segment, scene_data, language, task_id, scenes_total)
+
+def render_commercial_segment(scene_data, language, segment_path, assets=None):
+    prompt_video = scene_data[0]
+    text = scene_data[1]
+    if assets is None:
+        assets = prefetch_commercial_assets([scene_data], language, os.path.dirname(segment_path))[0]
+    if not assets["video"]:
+        raise Exception("Failed to download video.")
+    if RENDER_BACKEND != "ffmpeg":
+        try:
+            return write_clip_segment(create_commercial_scene(prompt_video, language, text, assets=assets), segment_path)
+        finally:
+            release_clip_links(assets)
+
+    # Commercials have no overlays: mux the normalized clip with the voice, no frame goes through Python
+
+    audio_clip = AudioFileClip(assets["audio"])
+    duration = audio_clip.duration
+    audio_clip.close()
+
+    try:
+        assets["normalized"] = normalize_stock_clip(assets["video"], COMMERCIAL_SCENE_SIZE, duration)
+        mux_scene_segment(assets["normalized"], assets["audio"], duration, segment_path)
+    finally:
+        release_clip_links(assets)
+    os.remove(assets["audio"])
+    return segment_path
+
+def prefetch_commercial_assets(scenes_data, language, workdir):
+    # TTS and Pexels searches do not depend on each other: fire them all at once
+    scene_dirs = [scene_workspace(workdir, i) for i in range(len(scenes_data))]
+    audio_futures = [io_executor.submit(generate_audio_scene, scene_data[1], language, scene_dir) for scene_data, scene_dir in zip(scenes_data, scene_dirs)]
+    search_futures = [io_executor.submit(fetch_stock_videos, scene_data[0], 10) for scene_data in scenes_data]
+
+    # Only the pick of the Pexels clip has to wait for the audio duration
+    download_futures = []
+    for audio_future, search_future in zip(audio_futures, search_futures):
+        file_name = audio_future.result()
+        audio_clip = AudioFileClip(file_name)
+        duration = audio_clip.duration
+        audio_clip.close()
+
+        url_video = pick_stock_video(search_future.result(), 10, duration)
+        logger.debug(f"YYYYY url video Pexel {url_video}")
+        download_futures.append(io_executor.submit(download_stock_clip, url_video))
+
+    return [{"audio": audio_future.result(), "video": download_future.result()}
+            for audio_future, download_future in zip(audio_futures, download_futures)]
+
+def create_commercial_scene(prompt_video, language, text, duration=None, assets=None):
     logger.debug("create commercial scene...")
-    size = (1080, 720)
+    size = COMMERCIAL_SCENE_SIZE
 
-    file_name = generate_audio_scene(text, language)
+    if assets is None:
+        assets = prefetch_commercial_assets([[prompt_video, text]], language, "audios")[0]
+    file_name = assets["audio"]
 
     # Load the audio file
     audio_clip = AudioFileClip(file_name)
@@ -118,18 +223,14 @@ def create_commercial_scene(prompt_video, language, text, duration=None):
         duration = audio_clip.duration
     logger.debug(f"XXXXX audio duration {duration}")
 
-    url_video = search_for_stock_videos (prompt_video, 10, duration)
-    logger.debug(f"YYYYY url video Pexel {url_video}")
-
-    # Download video locally if needed
-    local_video_path = download_video(url_video, 'local_video.mp4')
+    local_video_path = assets["video"]
     if not local_video_path:
         logger.error("Failed to download video.")
         return None
 
-    video_clip = VideoFileClip(local_video_path)
-    # Resize video clip to a consistent size (e.g., 1280x720)
-    video_clip = video_clip.resize(size)
+    # One ffmpeg pass gives a clip already at the render size, fps and duration
+    assets["normalized"] = normalize_stock_clip(local_video_path, size, duration)
+    video_clip = VideoFileClip(assets["normalized"])
 
     
     # Set the duration of the image clip
@@ -140,74 +241,50 @@ def create_commercial_scene(prompt_video, language, text, duration=None):
 
     # Clean up local file after upload
     os.remove(file_name)
-    os.remove(local_video_path)
     
     return video_clip
     
 
 
 
-def generate_audio_scene(text, language):
+def generate_audio_scene(text, language, workdir="audios"):
     logger.debug("generate_audio_scene...")
     if language == "Spanish":
-        url = f"https://api.elevenlabs.io/v1/text-to-speech/{MOTIVATION_VOICE_ID_ES}"
+        voice_id = MOTIVATION_VOICE_ID_ES
     if language == "French":
-        url = f"https://api.elevenlabs.io/v1/text-to-speech/{MOTIVATION_VOICE_ID_FR}"
+        voice_id = MOTIVATION_VOICE_ID_FR
     if language == "English":
-        url = f"https://api.elevenlabs.io/v1/text-to-speech/{MOTIVATION_VOICE_ID_EN}"
+        voice_id = MOTIVATION_VOICE_ID_EN
     else:
-        url = f"https://api.elevenlabs.io/v1/text-to-speech/{MOTIVATION_VOICE_ID_EN}"  
+        voice_id = MOTIVATION_VOICE_ID_EN  
     
-    headers = {
-        "Accept": "audio/mpeg",
-        "Content-Type": "application/json",
-        "xi-api-key": eleven_labs_api_key
-    }
-    data = {
-        "text": text,
-        "model_id": "eleven_turbo_v2_5",
-        "voice_settings": {
-        "stability": 0.5,
-        "similarity_boost": 0.5
-        }
-    }
     try:
-        response = requests.post(url, json=data, headers=headers)
-        response.raise_for_status()
-        temp_file_name = "audios/audio.mp3"
-        with open(temp_file_name, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
-                if chunk:
-                    f.write(chunk)
-
-        return temp_file_name
+        temp_file_name = os.path.join(workdir, f"audio_{uuid.uuid4()}.mp3")
+        return synthesize_speech(text, voice_id, temp_file_name)
         
     except Exception as e:
         print(f"Error generating audio: {e}")
         return None
 
 @video_commercial.route('/get_webinfo', methods=['GET'])
+@fail_softly("Failed to extract info")
 def get_webinfo():
     url = request.args.get('url')
     
     if url:
-        try:
-            completion = client.beta.chat.completions.parse(
-            #model="gpt-4o-2024-08-06",
-            model = "gpt-4o-mini",
-            
-            messages=[
-                {"role": "system", "content": PROMPT_SYSTEM_WEBINFO},
-                {"role": "user", "content": PROMPT_URL + url}
-            ],
-            response_format=Webinfo,
-            )
-            response = completion.choices[0].message.parsed
-            response_dict = response.model_dump()
-            return jsonify(response_dict)
-        except Exception as e:
-            print(f"Failed to extract info: {e}")
-            return None
+        response = cached_completion(
+        client,
+        #model="gpt-4o-2024-08-06",
+        model = "gpt-4o-mini",
+        
+        messages=[
+            {"role": "system", "content": PROMPT_SYSTEM_WEBINFO},
+            {"role": "user", "content": PROMPT_URL + url}
+        ],
+        response_format=Webinfo,
+        )
+        response_dict = response.model_dump()
+        return jsonify(response_dict)
     else:
         return jsonify({'error': 'No url provided'}), 400
     
@@ -1,10 +1,12 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, Response, stream_with_context
 from celery_app import celery
-from fonctions import delete_from_blob_storage, get_task_status, upload_to_blob_storage, search_for_stock_videos
-import requests
-import replicate
+from fonctions import delete_from_blob_storage, set_task_status, get_task_status, get_task_statuses, resolve_task_id, redis_client, upload_to_blob_storage, search_for_stock_videos, synthesize_speech, io_executor, fail_softly
 import os
 import json
+import hashlib
+import uuid
+from workspace import task_workspace, scene_workspace
+from images import generate_image_batch, create_prediction, wait_for_prediction
 from prompts.animation import ANIMATION_VOICE_ID_FR, ANIMATION_VOICE_ID_DEFAULT, ANIMATION_VOICE_ID_EN, ANIMATION_VOICE_ID_ES, CHUNK_SIZE
 
 generic_apis = Blueprint('generic_apis', __name__)
@@ -13,6 +15,11 @@ eleven_labs_api_key = os.getenv("ELEVENLABS_API_KEY")
 replicate_api_token = os.getenv("REPLICATE_API_TOKEN")
 pexel_api_key = os.getenv("PEXELS_API_KEY")
 
+SSE_KEEPALIVE_SECONDS = 15
+MAX_BULK_TASK_IDS = 200
+MAX_BATCH_IMAGES = 50
+MAX_BATCH_AUDIOS = 50
+
 
 @generic_apis.route('/', methods=['GET'])
 def get_test():
@@ -22,38 +29,85 @@ def get_test():
 def task_status_id(task_id):
     # Use the Redis-backed get_task_status function to retrieve status
     status = get_task_status(task_id)
-    return jsonify(status)
+    return conditional_json(status)
+
+@generic_apis.route('/task_statuses', methods=['GET'])
+def task_statuses():
+    # Bulk status for dashboards: /task_statuses?ids=<id1>,<id2>,...
+    task_ids = [task_id for task_id in request.args.get('ids', '').split(',') if task_id]
+    if not task_ids:
+        return jsonify({"error": "No task ids provided"}), 400
+    if len(task_ids) > MAX_BULK_TASK_IDS:
+        return jsonify({"error": f"At most {MAX_BULK_TASK_IDS} task ids per request"}), 400
+    return conditional_json({"statuses": get_task_statuses(task_ids)})
+
+def conditional_json(data):
+    # ETag on the content: an unchanged status answers 304 without a body
+    response = jsonify(data)
+    response.set_etag(hashlib.sha1(response.get_data()).hexdigest())
+    return response.make_conditional(request)
     
 
+@generic_apis.route('/task_events/<task_id>', methods=['GET'])
+def task_events(task_id):
+    # Server-Sent Events: forward the progress published by the render tasks
+    # instead of having the client poll task_status
+    def event_stream():
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        # Subscribe before reading the snapshot so no event falls in between
+        pubsub.subscribe(f"task_events:{resolve_task_id(task_id)}")
+        try:
+            snapshot = get_task_status(task_id)
+            yield f"data: {json.dumps(snapshot)}\n\n"
+            if snapshot.get("status") in ("completed", "failed"):
+                return
+
+            while True:
+                message = pubsub.get_message(timeout=SSE_KEEPALIVE_SECONDS)
+                if message is None:
+                    # Comment line: keeps proxies from closing an idle stream
+                    yield ": keepalive\n\n"
+                    continue
+                data = message["data"].decode()
+                yield f"data: {data}\n\n"
+                if json.loads(data).get("status") in ("completed", "failed"):
+                    return
+        finally:
+            pubsub.close()
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(stream_with_context(event_stream()), mimetype="text/event-stream", headers=headers)
+
+
 @generic_apis.route("/get_image", methods=['GET'])
 def generate_image():
     prompt = request.args.get('prompt')
-    # API endpoint for Replicate
-    url = "https://api.replicate.com/v1/models/black-forest-labs/flux-schnell/predictions"
-
-    # Headers for the request
-    headers = {
-        "Authorization": f"Bearer {replicate_api_token}",
-        "Content-Type": "application/json",
-        "Prefer": "wait"
-    }
-
-    # Payload for the request (JSON data)
-    data = {
-        "input": {
-            "prompt": prompt,
-            "output_format": "jpg"
-        }
-    }
-
-    # Make the POST request
-    response = requests.post(url, headers=headers, json=data)
-    initial_data = response.json()
-    image_id = initial_data["id"]
-    prediction = replicate.predictions.get(image_id)
-    response = prediction.json()
-    response2 = json.loads(response)
-    return response2["output"][0]
+    # "Prefer: wait" usually gets the finished prediction back in the same call;
+    # otherwise it is polled through the rate limited Replicate client
+    return wait_for_prediction(create_prediction(prompt, wait=True))
+
+
+@generic_apis.route("/get_images", methods=['POST'])
+def generate_images():
+    # Every scene prompt of a story in one call: answers with a job id at once and the
+    # images are generated by a worker; follow them on /task_events/<job_id>
+    prompts = (request.json or {}).get('prompts')
+    if not prompts:
+        return jsonify({"error": "No prompts provided"}), 400
+    if len(prompts) > MAX_BATCH_IMAGES:
+        return jsonify({"error": f"At most {MAX_BATCH_IMAGES} prompts per request"}), 400
+
+    job_id = str(uuid.uuid4())
+    set_task_status(job_id, "processing")
+    generate_images_in_background_celery.apply_async(args=[job_id, prompts])
+    return jsonify({"task_id": job_id}), 202
+
+@celery.task(name="image_batch_task")
+def generate_images_in_background_celery(job_id, prompts):
+    try:
+        generate_image_batch(job_id, prompts)
+    except Exception as e:
+        set_task_status(job_id, "failed", error=str(e))
 
     
 @generic_apis.route("/get_video_pexel", methods=['GET'])
@@ -66,51 +120,45 @@ def get_pexel_video():
 
 
 @generic_apis.route("/get_audio", methods=['GET'])
+@fail_softly("Error generating audio")
 def generate_audio():
     text = request.args.get('text')
     language = request.args.get('language')
-
-    if language == "Spanish":
-        url = f"https://api.elevenlabs.io/v1/text-to-speech/{ANIMATION_VOICE_ID_ES}"
+    
+    with task_workspace(f"audio-{uuid.uuid4()}") as workdir:
+        return synthesize_and_upload(text, audio_voice_id(language), workdir)
+
+@generic_apis.route("/get_audios", methods=['POST'])
+@fail_softly("Error generating audios", fallback=lambda e: (jsonify({"error": str(e)}), 500))
+def generate_audios():
+    # Every scene text of a story in one call; the blob names come back in scene order
+    data = request.json or {}
+    texts = data.get('texts')
+    language = data.get('language')
+    if not texts:
+        return jsonify({"error": "No texts provided"}), 400
+    if len(texts) > MAX_BATCH_AUDIOS:
+        return jsonify({"error": f"At most {MAX_BATCH_AUDIOS} texts per request"}), 400
+
+    voice_id = audio_voice_id(language)
+    with task_workspace(f"audios-{uuid.uuid4()}") as workdir:
+        # Synthesis and upload of each text run together on the shared I/O pool
+        futures = [io_executor.submit(synthesize_and_upload, text, voice_id, scene_workspace(workdir, i))
+                   for i, text in enumerate(texts)]
+        blob_names = [future.result() for future in futures]
+    return jsonify({"audios": blob_names})
+
+def audio_voice_id(language):
     if language == "French":
-        url = f"https://api.elevenlabs.io/v1/text-to-speech/{ANIMATION_VOICE_ID_FR}"
+        return ANIMATION_VOICE_ID_FR
     if language == "English":
-        url = f"https://api.elevenlabs.io/v1/text-to-speech/{ANIMATION_VOICE_ID_EN}"
-    else:
-        url = f"https://api.elevenlabs.io/v1/text-to-speech/{ANIMATION_VOICE_ID_ES}"  
-    
-    headers = {
-        "Accept": "audio/mpeg",
-        "Content-Type": "application/json",
-        "xi-api-key": eleven_labs_api_key
-    }
-    data = {
-        "text": text,
-        "model_id": "eleven_turbo_v2_5",
-        "voice_settings": {
-        "stability": 0.5,
-        "similarity_boost": 0.5
-        }
-    }
-    try:
-        response = requests.post(url, json=data, headers=headers)
-        response.raise_for_status()
-        temp_file_name = "audios/audio.mp3"
-        with open(temp_file_name, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
-                if chunk:
-                    f.write(chunk)
-    
-        blob_name = upload_to_blob_storage(temp_file_name, "audio")
-
-        # Clean up local file after upload
-        #os.remove(temp_file_name)
+        return ANIMATION_VOICE_ID_EN
+    return ANIMATION_VOICE_ID_ES
 
-        return blob_name
-        
-    except Exception as e:
-        print(f"Error generating audio: {e}")
-        return None
+def synthesize_and_upload(text, voice_id, workdir):
+    temp_file_name = os.path.join(workdir, "audio.mp3")
+    synthesize_speech(text, voice_id, temp_file_name)
+    return upload_to_blob_storage(temp_file_name, "audio")
 
 @generic_apis.route('/delete_audio_files', methods=['POST'])
 def delete_audio_files():
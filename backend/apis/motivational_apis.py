@@ -1,13 +1,16 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, Response, stream_with_context
 import uuid
 from openai import OpenAI
 from pydantic import BaseModel
 from typing import List
 from celery_app import celery
-import requests
 import logging
 import traceback
-from fonctions import set_task_status, upload_to_blob_storage, create_video_with_scenes, search_for_stock_videos, download_video, logger
+from fonctions import set_task_status, upload_to_blob_storage, create_video_with_scenes, fetch_stock_videos, pick_stock_video, download_stock_clip, normalize_stock_clip, release_clip_links, io_executor, synthesize_speech, publish_progress, logger, fail_softly
+from subtitles import add_subtitle_track
+from workspace import task_workspace, scene_workspace
+from llm_cache import cached_completion, story_event_stream, OPENAI_TIMEOUT, OPENAI_MAX_RETRIES
+from render import SCENE_FANOUT, SEGMENT_ASSEMBLY, submit_render, check_render_attempts, warm_assets, render_scenes_in_parallel, render_and_upload_segment, render_video_from_segments, write_clip_segment
 from moviepy.editor import *
 from prompts.motivation import PROMPT_SYSTEM_MOTIVATION, PROMPT_USER1, PROMPT_USER2, MOTIVATION_VOICE_ID_ES, MOTIVATION_VOICE_ID_EN, MOTIVATION_VOICE_ID_FR, CHUNK_SIZE
 
@@ -17,7 +20,12 @@ api_key = os.getenv('OPENAI_API_KEY')
 eleven_labs_api_key = os.getenv("ELEVENLABS_API_KEY")
 pexels_api_key=os.getenv("PEXELS_API_KEY")
 
-client = OpenAI(api_key=api_key)
+client = OpenAI(api_key=api_key, timeout=OPENAI_TIMEOUT, max_retries=OPENAI_MAX_RETRIES)
+
+# Name of this pipeline in the render deduplication and segment cache keys
+PIPELINE = "motivation"
+# Whether the background music is mixed under the voice
+BACKGROUND_MUSIC = "true"
 
 class Scene(BaseModel):
    sentences: str
@@ -28,33 +36,46 @@ class Story(BaseModel):
     complete_story: str
 
 
+def story_messages(topic, language):
+    return [
+        {"role": "system", "content": PROMPT_SYSTEM_MOTIVATION},
+        {"role": "user", "content": PROMPT_USER1 + topic},
+        {"role": "user", "content": PROMPT_USER2 + language}
+    ]
+
 @video_motivation.route('/get_motivational', methods=['GET'])
+@fail_softly("Failed to generate motivational script")
 def generate_story():
     topic = request.args.get('topic')
     language = request.args.get('language')
     
     if topic and language:
-        try:
-            completion = client.beta.chat.completions.parse(
-            #model="gpt-4o-2024-08-06",
-            model = "gpt-4o-mini",
-            
-            messages=[
-                {"role": "system", "content": PROMPT_SYSTEM_MOTIVATION},
-                {"role": "user", "content": PROMPT_USER1 + topic},
-                {"role": "user", "content": PROMPT_USER2 +language}
-            ],
-            response_format=Story,
-            )
-            response = completion.choices[0].message.parsed
-            response_dict = response.model_dump()
-            return jsonify(response_dict)
-        except Exception as e:
-            print(f"Failed to generate motivational script: {e}")
-            return None
+        response = cached_completion(
+        client,
+        #model="gpt-4o-2024-08-06",
+        model = "gpt-4o-mini",
+        
+        messages=story_messages(topic, language),
+        response_format=Story,
+        )
+        response_dict = response.model_dump()
+        return jsonify(response_dict)
     else:
         return jsonify({'error': 'No topic provided'}), 400
 
+@video_motivation.route('/get_motivational_stream', methods=['GET'])
+def generate_story_stream():
+    # Same story as /get_motivational, sent as Server-Sent Events: one "scene" event per scene
+    # as soon as it is generated, then the full "story"
+    topic = request.args.get('topic')
+    language = request.args.get('language')
+    if not (topic and language):
+        return jsonify({'error': 'No topic provided'}), 400
+
+    events = story_event_stream(client, model="gpt-4o-mini", messages=story_messages(topic, language), response_format=Story)
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(stream_with_context(events), mimetype="text/event-stream", headers=headers)
+
 @video_motivation.route('/motivation_video_editor', methods=['POST'])
 def motivation_video_editor():
     scene_data = request.json.get('scene_data')
@@ -62,28 +83,51 @@ def motivation_video_editor():
     if not scene_data:
         return jsonify({"error": "No scene data provided"}), 400
     
-    task_id = str(uuid.uuid4())
-
-    # Start the video generation process as a Celery task
-    generate_motivation_video_in_background_celery.apply_async(args=[task_id, scene_data])
+    # Start the video generation process as a Celery task, unless the same video
+    # is already rendered or rendering
+    task_id, video_url = submit_render(PIPELINE, warm_motivation_assets_celery, generate_motivation_video_in_background_celery, scene_data, BACKGROUND_MUSIC)
+    if video_url:
+        return jsonify({"task_id": task_id, "video_url": video_url}), 200
 
     return jsonify({"task_id": task_id}), 202
 
 @celery.task(name="motivation_video_task")
 def generate_motivation_video_in_background_celery(task_id, scenes_data):
     try:
-        output_path = f"final_video_{uuid.uuid4()}.mp4"
-        scenes = []
-        logger.debug("Generate_motivation_video_in_background....")
-
-        for scene_data in scenes_data:
-            prompt_video = scene_data[0]
-            text = scene_data[1]
-            scenes.append(create_motivation_scene(prompt_video, "Spanish", text))
-
-        music = "true"
-        create_video_with_scenes(scenes, output_path, music)
-        video_url = upload_to_blob_storage(output_path, "video")
+        if not check_render_attempts(task_id):
+            return
+
+        if SCENE_FANOUT:
+            scene_tasks = [render_motivation_scene_celery.s(scene_data, "Spanish", task_id, len(scenes_data)) for scene_data in scenes_data]
+            render_scenes_in_parallel(task_id, scene_tasks, BACKGROUND_MUSIC)
+            return
+
+        # Every file of this render lives in its own scratch directory
+        with task_workspace(task_id) as workdir:
+            scenes = []
+            logger.debug("Generate_motivation_video_in_background....")
+
+            music = BACKGROUND_MUSIC
+            if SEGMENT_ASSEMBLY:
+                # Only the scenes missing from the segment cache are fetched and rendered
+                video_url = render_video_from_segments(task_id, PIPELINE, scenes_data, prefetch_motivation_assets, render_motivation_segment, "Spanish", music, workdir)
+            else:
+                # Start the TTS and Pexels requests of every scene at once
+                scenes_assets = prefetch_motivation_assets(scenes_data, "Spanish", workdir)
+                publish_progress(task_id, "assets", 20)
+
+                output_path = os.path.join(workdir, f"final_video_{uuid.uuid4()}.mp4")
+                for scene_data, assets in zip(scenes_data, scenes_assets):
+                    prompt_video = scene_data[0]
+                    text = scene_data[1]
+                    scenes.append(create_motivation_scene(prompt_video, "Spanish", text, assets=assets))
+                publish_progress(task_id, "encoding", 30)
+                try:
+                    create_video_with_scenes(scenes, output_path, music)
+                finally:
+                    for assets in scenes_assets:
+                        release_clip_links(assets)
+                video_url = upload_to_blob_storage(output_path, "video")
 
         # Update task status to completed
         set_task_status(task_id, "completed", video_url=video_url)
@@ -93,11 +137,54 @@ def generate_motivation_video_in_background_celery(task_id, scenes_data):
         logger.error(f"Error in generate_video_in_background: {traceback.format_exc()}")
         set_task_status(task_id, "failed", error=str(e))
 
-def create_motivation_scene(prompt_video, language, text, duration=None):
+@celery.task(name="motivation_assets_task")
+def warm_motivation_assets_celery(scenes_data, language):
+    warm_assets(PIPELINE, prefetch_motivation_assets, scenes_data, language)
+
+@celery.task(name="motivation_scene_task")
+def render_motivation_scene_celery(scene_data, language, task_id, scenes_total):
+    return render_and_upload_segment(PIPELINE, render_motivation_segment, scene_data, language, task_id, scenes_total)
+
+def render_motivation_segment(scene_data, language, segment_path, assets=None):
+    prompt_video = scene_data[0]
+    text = scene_data[1]
+    if assets is None:
+        assets = prefetch_motivation_assets([scene_data], language, os.path.dirname(segment_path))[0]
+    if not assets["video"]:
+        raise Exception("Failed to download video.")
+    try:
+        return write_clip_segment(create_motivation_scene(prompt_video, language, text, assets=assets), segment_path)
+    finally:
+        release_clip_links(assets)
+
+def prefetch_motivation_assets(scenes_data, language, workdir):
+    # TTS and Pexels searches do not depend on each other: fire them all at once
+    scene_dirs = [scene_workspace(workdir, i) for i in range(len(scenes_data))]
+    audio_futures = [io_executor.submit(generate_audio_scene, scene_data[1], language, scene_dir) for scene_data, scene_dir in zip(scenes_data, scene_dirs)]
+    search_futures = [io_executor.submit(fetch_stock_videos, scene_data[0], 10) for scene_data in scenes_data]
+
+    # Only the pick of the Pexels clip has to wait for the audio duration
+    download_futures = []
+    for audio_future, search_future in zip(audio_futures, search_futures):
+        file_name = audio_future.result()
+        audio_clip = AudioFileClip(file_name)
+        duration = audio_clip.duration
+        audio_clip.close()
+
+        url_video = pick_stock_video(search_future.result(), 10, duration)
+        logger.debug(f"YYYYY url video Pexel {url_video}")
+        download_futures.append(io_executor.submit(download_stock_clip, url_video))
+
+    return [{"audio": audio_future.result(), "video": download_future.result()}
+            for audio_future, download_future in zip(audio_futures, download_futures)]
+
+def create_motivation_scene(prompt_video, language, text, duration=None, assets=None):
     logger.debug("create motivation scene...")
     size = (1080, 720)
 
-    file_name = generate_audio_scene(text, language)
+    if assets is None:
+        assets = prefetch_motivation_assets([[prompt_video, text]], language, "audios")[0]
+    file_name = assets["audio"]
 
     # Load the audio file
     audio_clip = AudioFileClip(file_name)
@@ -107,18 +194,14 @@ def create_motivation_scene(prompt_video, language, text, duration=None):
         duration = audio_clip.duration
     logger.debug(f"XXXXX audio duration {duration}")
 
-    url_video = search_for_stock_videos (prompt_video, 10, duration)
-    logger.debug(f"YYYYY url video Pexel {url_video}")
-
-    # Download video locally if needed
-    local_video_path = download_video(url_video, 'local_video.mp4')
+    local_video_path = assets["video"]
     if not local_video_path:
         logger.error("Failed to download video.")
         return None
 
-    video_clip = VideoFileClip(local_video_path)
-    # Resize video clip to a consistent size (e.g., 1280x720)
-    video_clip = video_clip.resize(size)
+    # One ffmpeg pass gives a clip already at the render size, fps and duration
+    assets["normalized"] = normalize_stock_clip(local_video_path, size, duration)
+    video_clip = VideoFileClip(assets["normalized"])
 
     
     # Set the duration of the image clip
@@ -127,73 +210,45 @@ def create_motivation_scene(prompt_video, language, text, duration=None):
     # Set the audio for the image clip
     #video_clip = video_clip.set_audio(audio_clip)
 
-    # Create word-by-word TextClips
+    # Create word-by-word subtitles
     words = text.split()
     phrase_length = 4  # Number of words per phrase (adjust as needed)
     phrases = [" ".join(words[i:i + phrase_length]) for i in range(0, len(words), phrase_length)]
     phrase_duration = duration / len(phrases)  # Set duration for each phrase to appear
 
-    # Create TextClips for each phrase and arrange them in sequence
-    phrase_clips = []
-    for i, phrase in enumerate(phrases):
-        try:
-            phrase_clip = TextClip(phrase, fontsize=40, color='white', font='DejaVu-Sans-Bold')
-            phrase_clip = phrase_clip.set_position(('center', 'center')).set_duration(phrase_duration)
-            phrase_clip = phrase_clip.set_start(i * phrase_duration)  # Set when each phrase appears
-            phrase_clips.append(phrase_clip)
-        except Exception as e:
-            logger.debug(f"Failed to create TextClip for phrase '{phrase}'. Error: {str(e)}")
-            raise Exception(f"Failed to create TextClip for phrase '{phrase}'. Error: {str(e)}")
-        
-    # Overlay the phrases on top of the image using CompositeVideoClip
-    video_clip_with_text = CompositeVideoClip([video_clip] + phrase_clips).set_audio(audio_clip)
+    # One subtitle track that only draws the phrase active at each frame
+    timings = [(i * phrase_duration, (i + 1) * phrase_duration, phrase) for i, phrase in enumerate(phrases)]
+    try:
+        video_clip_with_text = add_subtitle_track(video_clip, timings, fontsize=40, color='white').set_audio(audio_clip)
+    except Exception as e:
+        logger.debug(f"Failed to create subtitles. Error: {str(e)}")
+        raise Exception(f"Failed to create subtitles. Error: {str(e)}")
 
     # Set the audio for the video clip
     video_clip_with_text = video_clip_with_text.set_audio(audio_clip)
 
     # Clean up local file after upload
     os.remove(file_name)
-    os.remove(local_video_path)
     
     #return video_clip
     return video_clip_with_text
 
 
 
-def generate_audio_scene(text, language):
+def generate_audio_scene(text, language, workdir="audios"):
     logger.debug("generate_audio_scene...")
     if language == "Spanish":
-        url = f"https://api.elevenlabs.io/v1/text-to-speech/{MOTIVATION_VOICE_ID_ES}"
+        voice_id = MOTIVATION_VOICE_ID_ES
     if language == "French":
-        url = f"https://api.elevenlabs.io/v1/text-to-speech/{MOTIVATION_VOICE_ID_FR}"
+        voice_id = MOTIVATION_VOICE_ID_FR
     if language == "English":
-        url = f"https://api.elevenlabs.io/v1/text-to-speech/{MOTIVATION_VOICE_ID_EN}"
+        voice_id = MOTIVATION_VOICE_ID_EN
     else:
-        url = f"https://api.elevenlabs.io/v1/text-to-speech/{MOTIVATION_VOICE_ID_EN}"  
+        voice_id = MOTIVATION_VOICE_ID_EN  
     
-    headers = {
-        "Accept": "audio/mpeg",
-        "Content-Type": "application/json",
-        "xi-api-key": eleven_labs_api_key
-    }
-    data = {
-        "text": text,
-        "model_id": "eleven_turbo_v2_5",
-        "voice_settings": {
-        "stability": 0.5,
-        "similarity_boost": 0.5
-        }
-    }
     try:
-        response = requests.post(url, json=data, headers=headers)
-        response.raise_for_status()
-        temp_file_name = "audios/audio.mp3"
-        with open(temp_file_name, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
-                if chunk:
-                    f.write(chunk)
-
-        return temp_file_name
+        temp_file_name = os.path.join(workdir, f"audio_{uuid.uuid4()}.mp3")
+        return synthesize_speech(text, voice_id, temp_file_name)
         
     except Exception as e:
         print(f"Error generating audio: {e}")
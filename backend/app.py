@@ -1,4 +1,4 @@
-from flask import Flask
+from flask import Flask, jsonify
 from flask_cors import CORS
 from flask_migrate import Migrate
 import os
@@ -9,6 +9,7 @@ from apis.generic_apis import generic_apis
 from apis.db_apis import db_apis
 from db_app import db
 from celery_app import celery
+from ratelimit import RateLimitExceeded
 
 app = Flask(__name__)
 CORS(app)
@@ -28,6 +29,12 @@ app.register_blueprint(db_apis, url_prefix='/db_apis')
 
 migrate = Migrate(app, db)
 
+@app.errorhandler(RateLimitExceeded)
+def rate_limit_exceeded(e):
+    # A provider's fleet-wide quota is used up for a while: tell the client when to come back
+    retry_after = max(1, round(e.retry_after))
+    return jsonify({"error": str(e)}), 429, {"Retry-After": str(retry_after)}
+
 # Ensure database tables are created
 with app.app_context():
     db.create_all()
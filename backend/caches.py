@@ -0,0 +1,145 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+
+
+def content_key(*parts):
+    # Stable hash of any JSON-serialisable inputs
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+# Directory of files bounded in total size, evicting the least recently used.
+# Entries are written to a temp file and renamed into place, so several
+# workers on the same node can share the directory safely.
+class DiskLRUCache:
+    def __init__(self, directory, max_bytes, suffix="", link_max_age=6 * 3600):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        # Caller-owned hard links to entries: a sibling directory on the same volume, so
+        # linking never copies and eviction never removes a file that is still in use
+        self.link_directory = f"{directory}-links"
+        self.link_max_age = link_max_age
+        os.makedirs(directory, exist_ok=True)
+        os.makedirs(self.link_directory, exist_ok=True)
+
+    def path_for(self, key):
+        return os.path.join(self.directory, f"{key}{self.suffix}")
+
+    def get(self, key):
+        path = self.path_for(key)
+        try:
+            # Bump the access time used for the LRU order
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    @contextmanager
+    def staging_path(self, key, suffix=""):
+        # Yields a temp path to fill (e.g. by a subprocess); the entry only appears once the block succeeds
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=f".part{suffix}")
+        os.close(fd)
+        try:
+            yield temp_path
+            os.replace(temp_path, self.path_for(key))
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self.evict()
+
+    @contextmanager
+    def writer(self, key):
+        # Yields an open temp file; the entry only appears once the block succeeds
+        with self.staging_path(key) as temp_path:
+            with open(temp_path, "wb") as f:
+                yield f
+
+    def put_file(self, key, src_path):
+        with self.writer(key) as f, open(src_path, "rb") as src:
+            shutil.copyfileobj(src, f)
+        return self.path_for(key)
+
+    def copy_to(self, key, dest_path):
+        # Give the caller its own link to the entry so deleting it never hurts the cache
+        path = self.get(key)
+        if path is None:
+            return None
+        # Never write through an old link to another entry
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+        try:
+            os.link(path, dest_path)
+        except OSError:
+            shutil.copyfile(path, dest_path)
+        return dest_path
+
+    def link_entry(self, key, path):
+        # The link name keeps the key, see entry_key
+        link_path = os.path.join(self.link_directory, f"{key}-{uuid.uuid4().hex}{self.suffix}")
+        try:
+            os.link(path, link_path)
+        except FileNotFoundError:
+            # Evicted in the meantime
+            return None
+        except OSError:
+            shutil.copyfile(path, link_path)
+        return link_path
+
+    def checkout(self, key):
+        # Like copy_to, for callers without a directory on this volume: the returned
+        # link belongs to the caller, who deletes it once done
+        path = self.get(key)
+        if path is None:
+            return None
+        return self.link_entry(key, path)
+
+    def entry_key(self, path):
+        # Key of an entry path or of a link handed out by checkout
+        name = os.path.basename(path)
+        if self.suffix and name.endswith(self.suffix):
+            name = name[:-len(self.suffix)]
+        return name.split("-")[0]
+
+    def sweep_links(self):
+        # Links whose owner died before deleting them
+        now = time.time()
+        for name in os.listdir(self.link_directory):
+            path = os.path.join(self.link_directory, name)
+            try:
+                if now - os.stat(path).st_mtime > self.link_max_age:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def evict(self):
+        self.sweep_links()
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if ".part" in name:
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
@@ -1,6 +1,14 @@
 from celery import Celery
 import os
 
+# Network-bound stages (TTS, Pexels, downloads, Replicate) go to a thread-pool worker with
+# high concurrency, encoding stays on a prefork worker sized to the cores (see compose.yml)
+IO_QUEUE = os.getenv("CELERY_IO_QUEUE", "io")
+CPU_QUEUE = os.getenv("CELERY_CPU_QUEUE", "cpu")
+# A task is only acknowledged once it has finished, so the broker hands it to another
+# worker if this one is killed; it must stay unacknowledged longer than the slowest render
+VISIBILITY_TIMEOUT = int(os.getenv("CELERY_VISIBILITY_TIMEOUT", str(3 * 3600)))
+
 def make_celery(app_name=__name__):
     celery = Celery(
         app_name,
@@ -11,6 +19,15 @@ def make_celery(app_name=__name__):
      #   broker_use_ssl={'ssl_cert_reqs': os.getenv('SSL_CERT_REQS', 'CERT_NONE')},
       #  result_backend_use_ssl={'ssl_cert_reqs': os.getenv('SSL_CERT_REQS', 'CERT_NONE')}
     #)
+    celery.conf.task_acks_late = True
+    celery.conf.task_reject_on_worker_lost = True
+    celery.conf.worker_prefetch_multiplier = 1
+    celery.conf.broker_transport_options = {"visibility_timeout": VISIBILITY_TIMEOUT}
+    celery.conf.task_default_queue = CPU_QUEUE
+    celery.conf.task_routes = {
+        "*_assets_task": {"queue": IO_QUEUE},
+        "image_batch_task": {"queue": IO_QUEUE},
+    }
     return celery
 
 celery = make_celery()
\ No newline at end of file
@@ -0,0 +1,165 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import uuid
+from PIL import Image
+from celery.utils.log import get_task_logger
+from caches import content_key
+
+logger = get_task_logger(__name__)
+
+FFMPEG_BINARY = os.getenv("FFMPEG_BINARY", "ffmpeg")
+
+# Render profile of the final videos
+RENDER_FPS = 14
+
+
+def run_ffmpeg(args):
+    command = [FFMPEG_BINARY, "-y", "-hide_banner", "-loglevel", "error"] + args
+    logger.debug(f"Running {' '.join(command)}")
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise Exception(f"ffmpeg failed: {result.stderr.decode(errors='replace')}")
+
+
+def normalize_clip(cache, source_path, size, duration):
+    # Transcode a stock clip once to the render size, fps and scene duration so the
+    # compositor never resizes frames in Python. The result sits in the same cache as the source;
+    # the caller gets its own link to it (see DiskLRUCache.checkout) and deletes it once done.
+    width, height = size
+    duration = round(duration, 2)
+    key = content_key(cache.entry_key(source_path), width, height, RENDER_FPS, duration)
+    link_path = cache.checkout(key)
+    if link_path:
+        logger.debug(f"Normalized clip cache hit for {source_path}")
+        return link_path
+
+    with cache.staging_path(key, suffix=".mp4") as temp_path:
+        run_ffmpeg([
+            # Loop short clips so the scene is always filled
+            "-stream_loop", "-1", "-i", source_path,
+            "-t", str(duration),
+            "-vf", f"scale={width}:{height},setsar=1,fps={RENDER_FPS}",
+            "-an", "-c:v", "libx264", "-preset", "ultrafast", "-crf", "18", "-pix_fmt", "yuv420p",
+            temp_path
+        ])
+        # Linked before the entry is published, so an eviction cannot take it first
+        link_path = cache.link_entry(key, temp_path)
+    return link_path
+
+
+def mux_scene_segment(video_path, audio_path, duration, segment_path):
+    # A pre-normalized clip needs no compositing: copy its video stream and add the voice
+    run_ffmpeg([
+        "-i", video_path, "-i", audio_path,
+        "-map", "0:v:0", "-map", "1:a:0",
+        "-t", str(duration),
+        "-c:v", "copy",
+        "-c:a", "aac", "-b:a", "128k", "-ar", "44100", "-ac", "2",
+        segment_path
+    ])
+    return segment_path
+
+
+def write_concat_list(segment_paths, list_path):
+    with open(list_path, "w") as f:
+        for segment_path in segment_paths:
+            escaped_path = os.path.abspath(segment_path).replace("'", "'\\''")
+            f.write(f"file '{escaped_path}'\n")
+
+
+def concat_args(list_path, music_path=None, music_volume=0.6):
+    # Join segments encoded with the same parameters through the concat demuxer,
+    # so no frame is decoded; only the audio is re-encoded when music is mixed in
+    args = ["-f", "concat", "-safe", "0", "-i", list_path]
+    if music_path:
+        args += [
+            "-stream_loop", "-1", "-i", music_path,
+            # amix halves each input, volume=2 restores the plain sum moviepy produces
+            "-filter_complex", f"[1:a]volume={music_volume}[music];[0:a][music]amix=inputs=2:duration=first,volume=2[audio]",
+            "-map", "0:v:0", "-map", "[audio]",
+            "-c:a", "aac", "-b:a", "128k"
+        ]
+    else:
+        args += ["-map", "0:v:0", "-map", "0:a:0?", "-c:a", "copy"]
+    return args + ["-c:v", "copy"]
+
+
+def concat_segments(segment_paths, output_path, music_path=None):
+    list_path = f"{output_path}.txt"
+    write_concat_list(segment_paths, list_path)
+    try:
+        run_ffmpeg(concat_args(list_path, music_path) + ["-movflags", "+faststart", output_path])
+    finally:
+        os.remove(list_path)
+    return output_path
+
+
+def stream_ffmpeg(args, chunk_size):
+    # Runs ffmpeg writing to stdout and yields its output in fixed-size chunks
+    # while it is still encoding; raises after the last chunk if ffmpeg failed
+    command = [FFMPEG_BINARY, "-y", "-hide_banner", "-loglevel", "error"] + args
+    logger.debug(f"Streaming {' '.join(command)}")
+    stderr = tempfile.TemporaryFile()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr)
+    try:
+        while True:
+            chunk = process.stdout.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+        if process.wait() != 0:
+            stderr.seek(0)
+            raise Exception(f"ffmpeg failed: {stderr.read().decode(errors='replace')}")
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        stderr.close()
+
+
+def stream_concat_segments(segment_paths, music_path=None, chunk_size=4 * 1024 * 1024):
+    # Fragmented MP4 needs no seek back to the header, so it can be written to a pipe
+    list_path = os.path.join(os.path.dirname(os.path.abspath(segment_paths[0])), f"concat_{uuid.uuid4()}.txt")
+    write_concat_list(segment_paths, list_path)
+    try:
+        args = concat_args(list_path, music_path) + [
+            "-movflags", "frag_keyframe+empty_moov+default_base_moof",
+            "-f", "mp4", "pipe:1"
+        ]
+        yield from stream_ffmpeg(args, chunk_size)
+    finally:
+        os.remove(list_path)
+
+
+def encode_still_segment(frames, audio_path, duration, segment_path):
+    # Static-background scene: each distinct pre-blended frame is written once and
+    # held by the concat demuxer, x264 then encodes it natively with -tune stillimage
+    frames_dir = tempfile.mkdtemp(prefix="still_", dir=os.path.dirname(os.path.abspath(segment_path)))
+    try:
+        list_path = os.path.join(frames_dir, "frames.txt")
+        with open(list_path, "w") as f:
+            frame_path = None
+            for i, (frame, frame_duration) in enumerate(frames):
+                frame_path = os.path.join(frames_dir, f"frame_{i}.png")
+                Image.fromarray(frame).save(frame_path, compress_level=1)
+                f.write(f"file '{frame_path}'\nduration {frame_duration:.3f}\n")
+            # The concat demuxer ignores the duration of the last entry unless it is repeated
+            if frame_path:
+                f.write(f"file '{frame_path}'\n")
+
+        run_ffmpeg([
+            "-f", "concat", "-safe", "0", "-i", list_path,
+            "-i", audio_path,
+            "-map", "0:v:0", "-map", "1:a:0",
+            "-vf", f"scale=trunc(iw/2)*2:trunc(ih/2)*2,fps={RENDER_FPS},format=yuv420p",
+            "-t", str(duration),
+            "-c:v", "libx264", "-preset", "ultrafast", "-tune", "stillimage",
+            "-c:a", "aac", "-b:a", "128k", "-ar", "44100", "-ac", "2",
+            segment_path
+        ])
+    finally:
+        shutil.rmtree(frames_dir, ignore_errors=True)
+    return segment_path
@@ -1,12 +1,20 @@
+import functools
 import logging
 import os
 from redis import Redis
+from redis.exceptions import ResponseError
 import json
 import uuid
 from celery.utils.log import get_task_logger
-from azure.storage.blob import BlobServiceClient
+from storage import storage
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from moviepy.editor import concatenate_videoclips, AudioFileClip, CompositeAudioClip
+from caches import DiskLRUCache, content_key
+from ratelimit import RateLimitedClient, RateLimitExceeded
+from werkzeug.exceptions import HTTPException
+from celery_app import VISIBILITY_TIMEOUT
+from ffmpeg_render import normalize_clip, concat_segments, stream_concat_segments, RENDER_FPS
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
 
@@ -27,23 +35,217 @@ redis_client = Redis(
 
 CHUNK_SIZE = 1024
 
+# One client per external provider, rate limited across the whole fleet through Redis.
+# Rates are requests per second, bursts the number of requests allowed back to back;
+# timeouts are (connect, read) in seconds
+elevenlabs_api = RateLimitedClient(redis_client, "elevenlabs",
+                                   rate=float(os.getenv("ELEVENLABS_RATE", "2")),
+                                   burst=int(os.getenv("ELEVENLABS_BURST", "5")),
+                                   timeout=(5, 60))
+pexels_api = RateLimitedClient(redis_client, "pexels",
+                               rate=float(os.getenv("PEXELS_RATE", str(200 / 3600))),
+                               burst=int(os.getenv("PEXELS_BURST", "20")),
+                               timeout=(5, 15))
+replicate_api = RateLimitedClient(redis_client, "replicate",
+                                  rate=float(os.getenv("REPLICATE_RATE", "10")),
+                                  burst=int(os.getenv("REPLICATE_BURST", "10")),
+                                  timeout=(5, 90))
+# OpenAI calls go through its SDK, which already retries with backoff: only the tokens are used
+openai_api = RateLimitedClient(redis_client, "openai",
+                               rate=float(os.getenv("OPENAI_RATE", "5")),
+                               burst=int(os.getenv("OPENAI_BURST", "10")),
+                               timeout=(5, 120))
+# Media downloads from the Pexels and Replicate CDNs are not rate limited, only timed out
+DOWNLOAD_TIMEOUT = (5, 60)
+
+# Shared pool for the network-bound prefetch of scene assets (TTS, Pexels, downloads)
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", "8"))
+io_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS)
+
+# ElevenLabs speech synthesis, shared by the three pipelines and /generic_apis/get_audio
+ELEVENLABS_MODEL_ID = "eleven_turbo_v2_5"
+ELEVENLABS_VOICE_SETTINGS = {
+    "stability": 0.5,
+    "similarity_boost": 0.5
+}
+tts_cache = DiskLRUCache(
+    os.getenv("TTS_CACHE_DIR", "cache/tts"),
+    int(os.getenv("TTS_CACHE_MAX_BYTES", str(500 * 1024 * 1024))),
+    suffix=".mp3"
+)
+
+# Per-node cache of downloaded stock clips, keyed by source URL
+clip_cache = DiskLRUCache(
+    os.getenv("CLIP_CACHE_DIR", "cache/clips"),
+    int(os.getenv("CLIP_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024))),
+    suffix=".mp4"
+)
+
+# Encoded scene segments, keyed by everything that goes into a scene (see render.segment_key):
+# an edited story only re-renders the scenes that changed
+segment_cache = DiskLRUCache(
+    os.getenv("SEGMENT_CACHE_DIR", "cache/segments"),
+    int(os.getenv("SEGMENT_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024))),
+    suffix=".mp4"
+)
+
+# "ffmpeg" joins per-scene segments natively, "moviepy" pulls every frame through concatenate_videoclips
+RENDER_BACKEND = os.getenv("RENDER_BACKEND", "ffmpeg")
+BACKGROUND_MUSIC_PATH = "audios/music.mp3"
+# Pipe the final fragmented MP4 straight into a block upload instead of writing it to disk
+STREAM_UPLOAD = os.getenv("STREAM_UPLOAD", "false") == "true"
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", str(4 * 1024 * 1024)))
+
+# Lifetime of the cached Pexels search responses, in seconds
+PEXELS_CACHE_TTL = int(os.getenv("PEXELS_CACHE_TTL", str(24 * 3600)))
+
+# How long the status and progress of a task are kept in Redis, in seconds
+TASK_STATUS_TTL = int(os.getenv("TASK_STATUS_TTL", str(7 * 24 * 3600)))
+# A render redelivered more often than this keeps killing its workers: give up on it
+RENDER_MAX_ATTEMPTS = int(os.getenv("RENDER_MAX_ATTEMPTS", "3"))
+# A render still in flight keeps its dedup entry only this long after its last progress
+# update, so a render whose messages were lost stops capturing identical requests; the
+# entry gets the whole TASK_STATUS_TTL once the video exists
+RENDER_DEDUP_TTL = VISIBILITY_TIMEOUT * RENDER_MAX_ATTEMPTS
+
+# Extends the dedup entry of a render only if it still points to that render
+REFRESH_RENDER_DEDUP_SCRIPT = """
+local dedup_key = redis.call('get', KEYS[1])
+if dedup_key and redis.call('get', dedup_key) == ARGV[1] then
+    return redis.call('expire', dedup_key, ARGV[2])
+end
+return 0
+"""
+
+# Container holding the per-scene segments rendered by the fan-out mode
+SEGMENT_CONTAINER = 'video-segments'
+
 def set_task_status(task_id, status, video_url=None, error=None):
     status_data = {"status": status}
     if video_url:
         status_data["video_url"] = video_url
     if error:
         status_data["error"] = error
-    redis_client.set(f"task_status:{task_id}", json.dumps(status_data))
+    event = None
+    # Terminal states are pushed to the SSE listeners too
+    if status in ("completed", "failed"):
+        event = {"stage": status, **status_data}
+        if status == "completed":
+            event["progress"] = 100
+    # Drop the outcome of a previous run, keep the progress fields
+    dedup_ttl = TASK_STATUS_TTL if status == "completed" else None
+    update_task_fields(task_id, {**status_data, **(event or {})}, event=event, clear=("video_url", "error"), dedup_ttl=dedup_ttl)
     logging.debug(f"Set task status in Redis for {task_id}: {status_data}")  # Debug log
 
-def get_task_status(task_id):
-    data = redis_client.get(f"task_status:{task_id}")
+def update_task_fields(task_id, fields, event=None, clear=(), dedup_ttl=None):
+    # Every field, the TTL refresh and the event go to Redis in one pipelined round-trip
+    key = f"task_status:{task_id}"
+    pipe = redis_client.pipeline()
+    if clear:
+        pipe.hdel(key, *clear)
+    pipe.hset(key, mapping={field: json.dumps(value) for field, value in fields.items()})
+    pipe.expire(key, TASK_STATUS_TTL)
+    if dedup_ttl:
+        pipe.eval(REFRESH_RENDER_DEDUP_SCRIPT, 1, f"render_dedup_of:{task_id}", task_id, dedup_ttl)
+    if event:
+        pipe.publish(f"task_events:{task_id}", json.dumps(event))
+    pipe.execute()
+
+def publish_progress(task_id, stage, progress=None, **details):
+    # Per-stage progress of a render, stored with the status and pushed on Redis pub/sub
+    event = {"stage": stage, **details}
+    if progress is not None:
+        event["progress"] = int(progress)
+    try:
+        # A render that makes progress is still alive: keep identical requests attached to it
+        update_task_fields(task_id, event, event=event, dedup_ttl=RENDER_DEDUP_TTL)
+    except Exception as e:
+        logger.error(f"Failed to publish progress for {task_id}: {e}")
+
+def publish_scene_done(task_id, scenes_total):
+    # Scenes may finish on different workers: count them in Redis
+    key = f"task_scenes_done:{task_id}"
+    pipe = redis_client.pipeline()
+    pipe.incr(key)
+    pipe.expire(key, TASK_STATUS_TTL)
+    scenes_done = pipe.execute()[0]
+    publish_progress(task_id, "scene", scene_progress(scenes_done, scenes_total), scene=scenes_done, scenes=scenes_total)
+
+def scene_progress(scenes_done, scenes_total):
+    # Assets take the first 20%, scene renders up to 80%, assembly and upload the rest
+    return 20 + 60 * scenes_done / scenes_total
+
+def decode_task_status(data):
+    if not data:
+        return {"status": "Rendering video"}
+    return {field.decode(): json.loads(value) for field, value in data.items()}
+
+def read_legacy_task_status(task_id):
+    # Tasks written before the hash layout hold one JSON string: WRONGTYPE for HGETALL
+    value = redis_client.get(f"task_status:{task_id}")
+    return json.loads(value) if value else {"status": "Rendering video"}
+
+def read_task_status(task_id):
+    try:
+        data = redis_client.hgetall(f"task_status:{task_id}")
+    except ResponseError:
+        return read_legacy_task_status(task_id)
     logging.debug(f"Retrieved task status from Redis for {task_id}: {data}")  # Debug log
-    return json.loads(data) if data else {"status": "Rendering video"}
+    return decode_task_status(data)
+
+def get_task_status(task_id):
+    status = read_task_status(task_id)
+    # A duplicate request reports the render it was attached to
+    if "leader" in status:
+        return read_task_status(status["leader"])
+    return status
+
+def read_task_statuses(task_ids):
+    pipe = redis_client.pipeline(transaction=False)
+    for task_id in task_ids:
+        pipe.hgetall(f"task_status:{task_id}")
+    # Old string keys come back as errors instead of failing the whole batch
+    return [read_legacy_task_status(task_id) if isinstance(data, ResponseError) else decode_task_status(data)
+            for task_id, data in zip(task_ids, pipe.execute(raise_on_error=False))]
+
+def get_task_statuses(task_ids):
+    # Status of many tasks in a single pipelined round-trip, plus one for attached tasks
+    statuses = dict(zip(task_ids, read_task_statuses(task_ids)))
+
+    attached = [task_id for task_id, status in statuses.items() if "leader" in status]
+    if attached:
+        leaders = read_task_statuses([statuses[task_id]["leader"] for task_id in attached])
+        statuses.update(zip(attached, leaders))
+    return statuses
+
+def resolve_task_id(task_id):
+    # Id of the render actually producing this task's video
+    try:
+        leader = redis_client.hget(f"task_status:{task_id}", "leader")
+    except ResponseError:
+        return task_id
+    return json.loads(leader) if leader else task_id
+
+def attach_task(task_id, leader_id):
+    update_task_fields(task_id, {"leader": leader_id})
+
+def fail_softly(message, fallback=lambda e: None):
+    # Blanket error handler of the provider-backed views; rate limits and Flask's own
+    # HTTP errors still reach the app's error handlers
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                return view(*args, **kwargs)
+            except (RateLimitExceeded, HTTPException):
+                raise
+            except Exception as e:
+                print(f"{message}: {e}")
+                return fallback(e)
+        return wrapper
+    return decorator
 
 def upload_to_blob_storage(local_file_path, type):
-    connect_str = os.getenv('AZURE_STORAGE_CONNECTION_STRING')
-    blob_service_client = BlobServiceClient.from_connection_string(connect_str)
     unique_id = uuid.uuid4()  # Generates a unique UUID
     if type == "video":
         container_name = 'video-files'
@@ -51,54 +253,66 @@ def upload_to_blob_storage(local_file_path, type):
     if type == "audio":
         container_name = 'audio-files'
         blob_name = f"{unique_id}.mp3"  # Create a unique blob name
-    blob_client = blob_service_client.get_blob_client(container=container_name, blob=blob_name)
+    if type == "segment":
+        container_name = SEGMENT_CONTAINER
+        blob_name = f"{unique_id}.mp4"  # Create a unique blob name
 
-    with open(local_file_path, "rb") as data:
-        blob_client.upload_blob(data)
+    storage.upload_file(container_name, blob_name, local_file_path)
     if type == "video":
-        blob_url = blob_client.url
+        blob_url = storage.url(container_name, blob_name)
         return blob_url
-    if type == "audio": 
+    if type == "audio" or type == "segment":
         return blob_name
 
 def download_blob(container_name, blob_name, download_file_path):
-    # Use the connection string from environment variables
-    connection_string = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
-    
-    # Initialize the BlobServiceClient
-    blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-    
-    # Get a client for the container and blob
-    blob_client = blob_service_client.get_blob_client(container_name, blob_name)
-
     # Download the blob to a local file
-    with open(download_file_path, "wb") as download_file:
-        download_file.write(blob_client.download_blob().readall())
+    storage.download_file(container_name, blob_name, download_file_path)
     
     logger.debug(f"Downloaded blob '{blob_name}' to '{download_file_path}'")
 
 # Function to delete a single file from Azure Blob Storage
-def delete_from_blob_storage(blob_name):
-    connect_str = os.getenv('AZURE_STORAGE_CONNECTION_STRING')
-    blob_service_client = BlobServiceClient.from_connection_string(connect_str)
-    
-    container_name = 'audio-files'
-    
-    blob_client = blob_service_client.get_blob_client(container=container_name, blob=blob_name)
+def delete_from_blob_storage(blob_name, container_name='audio-files'):
     try:
-        blob_client.delete_blob()
+        storage.delete(container_name, blob_name)
         print(f"Blob {blob_name} deleted successfully from container {container_name}.")
         return True
     except Exception as e:
         print(f"Failed to delete blob: {blob_name}. Error: {str(e)}")
         return False
     
+def synthesize_speech(text, voice_id, output_path):
+    # Same text, voice, model and settings always give the same audio: serve it from disk
+    key = content_key(text, voice_id, ELEVENLABS_MODEL_ID, ELEVENLABS_VOICE_SETTINGS)
+    if tts_cache.copy_to(key, output_path):
+        logger.debug(f"TTS cache hit for voice {voice_id}")
+        return output_path
+
+    url = f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}"
+    headers = {
+        "Accept": "audio/mpeg",
+        "Content-Type": "application/json",
+        "xi-api-key": os.getenv("ELEVENLABS_API_KEY")
+    }
+    data = {
+        "text": text,
+        "model_id": ELEVENLABS_MODEL_ID,
+        "voice_settings": ELEVENLABS_VOICE_SETTINGS
+    }
+    response = elevenlabs_api.post(url, json=data, headers=headers)
+    response.raise_for_status()
+    with tts_cache.writer(key) as f:
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            if chunk:
+                f.write(chunk)
+
+    return tts_cache.copy_to(key, output_path)
+
 def create_video_with_scenes(scenes, output_path, music):
     # Combine all the scenes into one video
     final_video = concatenate_videoclips(scenes)
-    background_music_path="audios/music.mp3"
+    background_music_path=BACKGROUND_MUSIC_PATH
 
-    final_video = final_video.set_fps(14)  # Reduce frame rate to 24fps for optimization
+    final_video = final_video.set_fps(RENDER_FPS)  # Reduce frame rate to 24fps for optimization
 
     if music == "true":
         background_music = AudioFileClip(background_music_path)
@@ -118,23 +332,65 @@ def create_video_with_scenes(scenes, output_path, music):
         final_video = final_video.set_audio(final_audio)
     
     # Export the video to MP4
-    final_video.write_videofile(output_path, codec='libx264', fps=14, preset='ultrafast', threads=4, audio_codec='aac', audio_bitrate='128k')
+    final_video.write_videofile(output_path, codec='libx264', fps=RENDER_FPS, preset='ultrafast', threads=4, audio_codec='aac', audio_bitrate='128k')
 
 
-def search_for_stock_videos(query: str, limit: int, min_dur: int):
+def create_video_from_segments(segment_paths, output_path, music):
+    # ffmpeg backend: scenes are already encoded segments, join them and mix the music natively
+    music_path = BACKGROUND_MUSIC_PATH if music == "true" else None
+    concat_segments(segment_paths, output_path, music_path)
+
+def publish_video_from_segments(segment_paths, music, workdir):
+    # Join the segments and upload the result, returns the video URL
+    if STREAM_UPLOAD:
+        # The upload overlaps the encode and no final file ever touches the disk
+        music_path = BACKGROUND_MUSIC_PATH if music == "true" else None
+        blob_name = f"{uuid.uuid4()}.mp4"
+        storage.upload_stream('video-files', blob_name, stream_concat_segments(segment_paths, music_path, STREAM_CHUNK_SIZE))
+        return storage.url('video-files', blob_name)
+
+    output_path = os.path.join(workdir, f"final_video_{uuid.uuid4()}.mp4")
+    try:
+        create_video_from_segments(segment_paths, output_path, music)
+        return upload_to_blob_storage(output_path, "video")
+    finally:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+
+
+def fetch_stock_videos(query: str, limit: int):
     logger.debug("search for stock videos...")
+    # LLM prompts repeat a lot: reuse the search results for the same normalized query
+    normalized_query = " ".join(query.lower().split())
+    cache_key = f"pexels_search:{content_key(normalized_query, limit)}"
+    try:
+        cached = redis_client.get(cache_key)
+        if cached:
+            logger.debug(f"Pexels search cache hit for '{normalized_query}'")
+            return json.loads(cached)
+    except Exception as e:
+        logger.error(f"Failed to read Pexels search cache: {e}")
+
     headers = {
         "Authorization": os.getenv("PEXELS_API_KEY"),
     }
 
-    qurl = f"https://api.pexels.com/videos/search?query={query}&per_page={limit}"
+    qurl = "https://api.pexels.com/videos/search"
 
-    r = requests.get(qurl, headers=headers)
+    r = pexels_api.get(qurl, headers=headers, params={"query": normalized_query, "per_page": limit})
     response = r.json()
 
     
     logger.debug(f"response from Pexel API: {response}")
+    if r.ok and response.get("videos"):
+        try:
+            redis_client.set(cache_key, json.dumps(response), ex=PEXELS_CACHE_TTL)
+        except Exception as e:
+            logger.error(f"Failed to write Pexels search cache: {e}")
+    return response
 
+
+def pick_stock_video(response, limit: int, min_dur: int):
     raw_urls = []
     target_width = 640
     target_height = 360
@@ -161,9 +417,14 @@ def search_for_stock_videos(query: str, limit: int, min_dur: int):
         logger.error(f"Error Searching for video: {e}")
 
 
+def search_for_stock_videos(query: str, limit: int, min_dur: int):
+    response = fetch_stock_videos(query, limit)
+    return pick_stock_video(response, limit, min_dur)
+
+
 def download_video(url, local_filename):
     try:
-        response = requests.get(url, stream=True)
+        response = requests.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT)
         response.raise_for_status()  # Raise error for bad status codes
         with open(local_filename, 'wb') as f:
             for chunk in response.iter_content(chunk_size=8192):
@@ -172,4 +433,40 @@ def download_video(url, local_filename):
         return local_filename
     except requests.RequestException as e:
         logger.error(f"Failed to download video: {e}")
-        return None
\ No newline at end of file
+        return None
+
+
+def download_stock_clip(url):
+    # Returns the caller's own link to the clip cache entry, see release_clip_links
+    key = content_key(url)
+    link_path = clip_cache.checkout(key)
+    if link_path:
+        logger.debug(f"Clip cache hit for {url}")
+        return link_path
+    try:
+        response = requests.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT)
+        response.raise_for_status()  # Raise error for bad status codes
+        with clip_cache.staging_path(key) as temp_path:
+            with open(temp_path, "wb") as f:
+                for chunk in response.iter_content(chunk_size=1024 * 1024):
+                    if chunk:
+                        f.write(chunk)
+            # Linked before the entry is published, so an eviction cannot take it first
+            link_path = clip_cache.link_entry(key, temp_path)
+        return link_path
+    except requests.RequestException as e:
+        logger.error(f"Failed to download video: {e}")
+        return None
+
+
+def normalize_stock_clip(local_video_path, size, duration):
+    # Pre-sized, pre-trimmed copy of a cached clip, stored next to it in the clip cache
+    return normalize_clip(clip_cache, local_video_path, size, duration)
+
+
+def release_clip_links(assets):
+    # Drop the scene's links to the clip cache once its segment or clip is written
+    for name in ("video", "normalized"):
+        path = assets.get(name)
+        if path and os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,87 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from fonctions import update_task_fields, set_task_status, replicate_api, logger
+
+REPLICATE_MODEL_URL = "https://api.replicate.com/v1/models/black-forest-labs/flux-schnell/predictions"
+REPLICATE_PREDICTION_URL = "https://api.replicate.com/v1/predictions/{}"
+# Predictions of one batch running at the same time on Replicate
+IMAGE_BATCH_CONCURRENCY = int(os.getenv("IMAGE_BATCH_CONCURRENCY", "4"))
+IMAGE_POLL_SECONDS = 1
+# Give up on a prediction that is still not finished after this many seconds
+IMAGE_PREDICTION_TIMEOUT = int(os.getenv("IMAGE_PREDICTION_TIMEOUT", "300"))
+
+replicate_api_token = os.getenv("REPLICATE_API_TOKEN")
+
+
+def replicate_headers():
+    return {
+        "Authorization": f"Bearer {replicate_api_token}",
+        "Content-Type": "application/json"
+    }
+
+
+def create_prediction(prompt, wait=False):
+    # Without "Prefer: wait" Replicate answers right away with the prediction id
+    headers = replicate_headers()
+    if wait:
+        headers["Prefer"] = "wait"
+    data = {
+        "input": {
+            "prompt": prompt,
+            "output_format": "jpg"
+        }
+    }
+    response = replicate_api.post(REPLICATE_MODEL_URL, headers=headers, json=data)
+    response.raise_for_status()
+    return response.json()
+
+
+def wait_for_prediction(prediction):
+    deadline = time.monotonic() + IMAGE_PREDICTION_TIMEOUT
+    while prediction["status"] not in ("succeeded", "failed", "canceled"):
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Prediction {prediction['id']} still {prediction['status']} after {IMAGE_PREDICTION_TIMEOUT}s")
+        time.sleep(IMAGE_POLL_SECONDS)
+        response = replicate_api.get(REPLICATE_PREDICTION_URL.format(prediction["id"]), headers=replicate_headers())
+        response.raise_for_status()
+        prediction = response.json()
+    if prediction["status"] != "succeeded":
+        raise RuntimeError(f"Prediction {prediction['id']} {prediction['status']}: {prediction.get('error')}")
+    return prediction["output"][0]
+
+
+def generate_image_url(prompt):
+    return wait_for_prediction(create_prediction(prompt))
+
+
+def generate_image_batch(job_id, prompts):
+    # Every image is published on the job as soon as it is ready, in completion order;
+    # the client follows them on /generic_apis/task_events/<job_id>
+    done = 0
+    failed = 0
+    with ThreadPoolExecutor(max_workers=IMAGE_BATCH_CONCURRENCY) as executor:
+        futures = {executor.submit(generate_image_url, prompt): i for i, prompt in enumerate(prompts)}
+        for future in as_completed(futures):
+            i = futures[future]
+            done += 1
+            event = {"stage": "image", "index": i, "images": len(prompts), "progress": int(100 * done / len(prompts))}
+            try:
+                event["image_url"] = future.result()
+            except Exception as e:
+                logger.error(f"Image {i} of job {job_id} failed: {e}")
+                event["error"] = str(e)
+                failed += 1
+            # image_<index> and image_<index>_error keep every result in the status for clients
+            # that connect late; the event's own image_url and error only describe this image
+            # and would read as the job's outcome there
+            fields = {key: value for key, value in event.items() if key not in ("image_url", "error")}
+            fields[f"image_{i}"] = event.get("image_url")
+            if "error" in event:
+                fields[f"image_{i}_error"] = event["error"]
+            update_task_fields(job_id, fields, event=event)
+
+    if failed == len(prompts):
+        set_task_status(job_id, "failed", error="No image could be generated")
+    else:
+        set_task_status(job_id, "completed")
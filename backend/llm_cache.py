@@ -0,0 +1,151 @@
+import json
+import os
+import threading
+import time
+import uuid
+from caches import content_key
+from fonctions import redis_client, openai_api, logger
+
+# Lifetime of a cached completion; Redis evicts it afterwards
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", str(24 * 3600)))
+# Options of the OpenAI clients: the SDK retries 429s and 5xx itself with jittered
+# backoff honoring Retry-After, openai_api spaces the calls across the fleet
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "120"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "5"))
+# The in-flight marker lives this long unless its leader keeps refreshing it: a dead
+# leader is replaced within seconds, a slow but alive one is never duplicated
+LLM_INFLIGHT_LOCK_TTL = int(os.getenv("LLM_INFLIGHT_LOCK_TTL", "30"))
+# Longest time an identical request waits for a live leader: its whole retry budget
+LLM_INFLIGHT_TIMEOUT = int(os.getenv("LLM_INFLIGHT_TIMEOUT", str(int(OPENAI_TIMEOUT * (OPENAI_MAX_RETRIES + 1)) + 60)))
+LLM_INFLIGHT_POLL_SECONDS = 0.2
+
+# Deletes the in-flight marker only if it still belongs to this caller
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Extends the in-flight marker only if it still belongs to this caller
+REFRESH_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class InflightLock:
+    # Refreshes the in-flight marker from a background thread while the leader's call runs
+
+    def __init__(self, lock_key, token):
+        self.lock_key = lock_key
+        self.token = token
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.keep_alive, daemon=True)
+
+    def keep_alive(self):
+        while not self.stopped.wait(LLM_INFLIGHT_LOCK_TTL / 3):
+            try:
+                if not redis_client.eval(REFRESH_LOCK_SCRIPT, 1, self.lock_key, self.token, LLM_INFLIGHT_LOCK_TTL):
+                    return
+            except Exception as e:
+                logger.error(f"Failed to refresh LLM in-flight marker: {e}")
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        redis_client.eval(RELEASE_LOCK_SCRIPT, 1, self.lock_key, self.token)
+
+
+def cached_completion(client, model, messages, response_format):
+    # Structured completion cached on (prompt, inputs, language, model, schema); concurrent
+    # identical requests, on any web worker, share a single upstream call
+    key = content_key(messages, model, response_format.model_json_schema())
+    cache_key = f"llm_cache:{key}"
+    lock_key = f"llm_inflight:{key}"
+
+    deadline = time.monotonic() + LLM_INFLIGHT_TIMEOUT
+    while True:
+        cached = redis_client.get(cache_key)
+        if cached:
+            logger.debug(f"LLM cache hit for {model}")
+            return response_format.model_validate_json(cached)
+
+        # A leader that died lets its marker expire and the next waiter takes over
+        token = str(uuid.uuid4())
+        if redis_client.set(lock_key, token, nx=True, ex=LLM_INFLIGHT_LOCK_TTL):
+            with InflightLock(lock_key, token):
+                return structured_completion(client, model, messages, response_format, cache_key)
+        if time.monotonic() > deadline:
+            # The leader outlived its whole retry budget: do not keep the user waiting on it
+            return structured_completion(client, model, messages, response_format, cache_key)
+        time.sleep(LLM_INFLIGHT_POLL_SECONDS)
+
+
+def structured_completion(client, model, messages, response_format, cache_key):
+    openai_api.acquire()
+    completion = client.beta.chat.completions.parse(
+        model=model,
+        messages=messages,
+        response_format=response_format,
+    )
+    response = completion.choices[0].message.parsed
+    redis_client.set(cache_key, response.model_dump_json(), ex=LLM_CACHE_TTL)
+    return response
+
+
+def stream_completion_scenes(client, model, messages, response_format):
+    # Structured completion streamed scene by scene: yields ("scene", index, scene) as soon as
+    # a scene is complete, then ("story", None, story) once the whole object is parsed
+    key = content_key(messages, model, response_format.model_json_schema())
+    cache_key = f"llm_cache:{key}"
+
+    cached = redis_client.get(cache_key)
+    if cached:
+        logger.debug(f"LLM cache hit for {model}")
+        story = response_format.model_validate_json(cached)
+        for i, scene in enumerate(story.scenes):
+            yield "scene", i, scene.model_dump()
+        yield "story", None, story
+        return
+
+    sent = 0
+    openai_api.acquire()
+    with client.beta.chat.completions.stream(
+        model=model,
+        messages=messages,
+        response_format=response_format,
+    ) as stream:
+        for event in stream:
+            if event.type != "content.delta" or not isinstance(event.parsed, dict):
+                continue
+            # The partial parse only tells a scene is finished once the next one has started
+            scenes = event.parsed.get("scenes") or []
+            while sent < len(scenes) - 1:
+                yield "scene", sent, scenes[sent]
+                sent += 1
+        story = stream.get_final_completion().choices[0].message.parsed
+
+    for i in range(sent, len(story.scenes)):
+        yield "scene", i, story.scenes[i].model_dump()
+    redis_client.set(cache_key, story.model_dump_json(), ex=LLM_CACHE_TTL)
+    yield "story", None, story
+
+
+def story_event_stream(client, model, messages, response_format):
+    # Server-Sent Events framing of stream_completion_scenes
+    try:
+        for kind, index, payload in stream_completion_scenes(client, model, messages, response_format):
+            if kind == "scene":
+                data = {"index": index, **payload}
+            else:
+                data = payload.model_dump()
+            yield f"event: {kind}\ndata: {json.dumps(data)}\n\n"
+    except Exception as e:
+        logger.error(f"Failed to stream structured completion: {e}")
+        yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
@@ -0,0 +1,164 @@
+import email.utils
+import os
+import random
+import time
+import requests
+from celery.signals import worker_init
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+
+# Statuses worth another try: rate limited or the provider is briefly unavailable
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+BACKOFF_BASE_SECONDS = 1
+BACKOFF_MAX_SECONDS = 60
+# Longest a caller sleeps for a token: past it the call fails fast instead of holding
+# a web thread for minutes
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "60"))
+# Celery workers wait longer: failing there throws a whole render away, so they only
+# give up well before the task's visibility timeout
+WORKER_RATE_LIMIT_MAX_WAIT = float(os.getenv("WORKER_RATE_LIMIT_MAX_WAIT", "1800"))
+# Bound used by the clients that do not set their own; switched on worker start
+default_max_wait = RATE_LIMIT_MAX_WAIT
+
+# Token bucket shared by every worker of the fleet. A request always takes its token,
+# possibly going into debt, and gets back how long to sleep before sending: callers
+# queue up in order instead of racing each other. A pause set after a 429 holds
+# everyone back until the provider's Retry-After has passed. A caller that would wait
+# longer than its max_wait leaves the bucket untouched and gives up.
+TOKEN_BUCKET_SCRIPT = """
+redis.replicate_commands()
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local max_wait = tonumber(ARGV[3])
+local clock = redis.call('time')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+
+local state = redis.call('hmget', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate) - 1
+
+local wait = math.max(0, -tokens / rate)
+local pause = redis.call('pttl', KEYS[2])
+if pause > 0 then
+    wait = math.max(wait, pause / 1000)
+end
+if wait > max_wait then
+    return tostring(wait)
+end
+
+-- The state must outlive the debt, or an expired key would hand out a full burst again
+redis.call('hset', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('expire', KEYS[1], math.ceil((burst - tokens) / rate) + 60)
+return tostring(wait)
+"""
+
+
+class RateLimitExceeded(Exception):
+    # The provider's token would only come after the caller's max_wait
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} rate limit exceeded, retry in {retry_after:.0f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+@worker_init.connect
+def use_worker_max_wait(**kwargs):
+    # Runs before the pool starts, so prefork children inherit it
+    global default_max_wait
+    default_max_wait = WORKER_RATE_LIMIT_MAX_WAIT
+
+
+def backoff_delay(attempt):
+    # Full jitter: retries of many workers spread out instead of arriving together
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+def retry_after_seconds(response):
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimitedClient:
+    # HTTP client of one external provider: fleet-wide rate limit, per-call timeout,
+    # and retries with backoff on 429, 5xx and connection errors
+
+    def __init__(self, redis, name, rate, burst, timeout, max_retries=5, max_wait=None):
+        self.redis = redis
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self._max_wait = max_wait
+        self.session = requests.Session()
+
+    @property
+    def max_wait(self):
+        return self._max_wait if self._max_wait is not None else default_max_wait
+
+    def acquire(self):
+        try:
+            wait = float(self.redis.eval(TOKEN_BUCKET_SCRIPT, 2, f"ratelimit:{self.name}", f"ratelimit_pause:{self.name}", self.rate, self.burst, self.max_wait))
+        except Exception as e:
+            # Redis trouble must not stop the renders: go on without the shared limit
+            logger.error(f"Rate limiter unavailable for {self.name}: {e}")
+            return
+        if wait > self.max_wait:
+            raise RateLimitExceeded(self.name, wait)
+        if wait > 0:
+            logger.debug(f"Waiting {wait:.2f}s for a {self.name} token")
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        # Every worker waits out the provider's Retry-After, not only the one that got the 429
+        try:
+            self.redis.set(f"ratelimit_pause:{self.name}", 1, px=max(1, int(seconds * 1000)))
+            return True
+        except Exception as e:
+            logger.error(f"Failed to pause {self.name} requests: {e}")
+            return False
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = backoff_delay(attempt)
+                logger.warning(f"{self.name} request failed ({e}), retrying in {delay:.1f}s")
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+                    return response
+                retry_after = retry_after_seconds(response)
+                delay = retry_after if retry_after is not None else backoff_delay(attempt)
+                response.close()
+                if delay > self.max_wait:
+                    raise RateLimitExceeded(self.name, delay)
+                logger.warning(f"{self.name} answered {response.status_code}, retrying in {delay:.1f}s")
+                if response.status_code == 429 and self.pause(delay):
+                    # The next acquire() waits out the pause
+                    delay = 0
+            time.sleep(delay)
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
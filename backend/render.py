@@ -0,0 +1,297 @@
+import os
+import uuid
+import traceback
+from celery import chain, chord
+from celery.signals import worker_process_init
+from celery_app import celery
+from fonctions import redis_client, get_task_status, read_task_status, attach_task, set_task_status, upload_to_blob_storage, download_blob, delete_from_blob_storage, create_video_with_scenes, publish_video_from_segments, publish_progress, publish_scene_done, scene_progress, release_clip_links, logger, segment_cache, SEGMENT_CONTAINER, RENDER_BACKEND, TASK_STATUS_TTL, RENDER_MAX_ATTEMPTS, RENDER_DEDUP_TTL
+from ffmpeg_render import RENDER_FPS
+from caches import content_key
+from workspace import task_workspace, scene_workspace, sweep_stale_workspaces
+from moviepy.editor import VideoFileClip
+
+# When enabled, every scene is rendered by its own Celery subtask and a chord
+# callback assembles the final video, so latency follows the slowest scene.
+SCENE_FANOUT = os.getenv("SCENE_FANOUT", "false") == "true"
+# Every scene is materialized to an encoded segment, its readers closed before the next
+# one starts, and the segments are joined by ffmpeg: memory and open files stay flat
+# whatever the number of scenes. Always on with the ffmpeg backend; "false" keeps the
+# moviepy backend's single concatenate_videoclips pass over every open clip
+SEGMENT_ASSEMBLY = RENDER_BACKEND == "ffmpeg" or os.getenv("SEGMENT_ASSEMBLY", "true") == "true"
+# Part of the deduplication key: bump it when a rendering change must not reuse older videos
+RENDER_PROFILE = os.getenv("RENDER_PROFILE", "1")
+
+# Deletes the dedup entry only if it still points to the given render
+RELEASE_RENDER_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+@worker_process_init.connect
+def clean_workspaces_on_start(**kwargs):
+    # A crashed worker never ran its cleanup: drop what it left in the scratch space
+    sweep_stale_workspaces()
+
+
+def canonical_scene_data(value):
+    # Stray whitespace from the editor must not make a different render
+    if isinstance(value, str):
+        return value.strip()
+    if isinstance(value, (list, tuple)):
+        return [canonical_scene_data(item) for item in value]
+    if isinstance(value, dict):
+        return {key: canonical_scene_data(item) for key, item in value.items()}
+    return value
+
+
+def render_key(pipeline, scenes_data, language, music):
+    return content_key(canonical_scene_data(scenes_data), pipeline, language, music, RENDER_BACKEND, RENDER_FPS, RENDER_PROFILE)
+
+
+def submit_render(pipeline, assets_task, render_task, scenes_data, music, language="Spanish"):
+    # Identical requests (retries, double submits, shared templates) share one render.
+    # Returns (task_id, video_url), video_url being set when that video already exists
+    task_id = str(uuid.uuid4())
+    dedup_key = f"render_dedup:{render_key(pipeline, scenes_data, language, music)}"
+    # Set before the dedup entry: a leader without a status is one that expired
+    set_task_status(task_id, "processing")
+    while True:
+        if redis_client.set(dedup_key, task_id, nx=True, ex=RENDER_DEDUP_TTL):
+            # Lets the render's progress updates keep its dedup entry alive
+            redis_client.set(f"render_dedup_of:{task_id}", dedup_key, ex=TASK_STATUS_TTL)
+            enqueue_render(task_id, assets_task, render_task, scenes_data, language)
+            return task_id, None
+
+        leader_id = redis_client.get(dedup_key)
+        if leader_id is None:
+            continue
+        leader_id = leader_id.decode()
+        status = get_task_status(leader_id)
+        if status.get("status") in ("processing", "completed"):
+            # The new id follows the leader: status, bulk status and SSE all resolve to it
+            attach_task(task_id, leader_id)
+            logger.debug(f"Task {task_id} attached to identical render {leader_id}")
+            return task_id, status.get("video_url")
+
+        # Failed or expired: the next identical request renders again
+        redis_client.eval(RELEASE_RENDER_SCRIPT, 1, dedup_key, leader_id)
+
+
+def enqueue_render(task_id, assets_task, render_task, scenes_data, language="Spanish"):
+    # The I/O worker fetches the scene assets into the shared caches, then a CPU
+    # worker renders and finds them there instead of waiting on the network
+    # Any task of the chain failing at the Celery level (time limit, crash of the assets
+    # task) would otherwise leave the status at "processing" forever
+    chain(assets_task.si(scenes_data, language), render_task.si(task_id, scenes_data)).apply_async(
+        link_error=render_failed_task.s(task_id))
+
+
+def warm_assets(pipeline, prefetch, scenes_data, language):
+    # Best effort: whatever is missing from the caches is fetched again by the render.
+    # Scenes whose segment is already cached need no asset at all
+    try:
+        scenes_data = [scene_data for scene_data in scenes_data if not segment_cache.get(segment_key(pipeline, scene_data, language))]
+        with task_workspace(f"assets-{uuid.uuid4()}") as workdir:
+            for assets in prefetch(scenes_data, language, workdir):
+                # Only the caches had to be filled: drop the links to them
+                if isinstance(assets, dict):
+                    release_clip_links(assets)
+    except Exception as e:
+        logger.error(f"Failed to prefetch scene assets: {e}")
+
+
+def write_clip_segment(clip, segment_path):
+    # Encode a composited moviepy scene with the same parameters as the final video.
+    # moviepy puts its temporary audio in the working directory under the output's
+    # name: keep it next to the segment so concurrent renders do not share it
+    temp_audiofile = os.path.join(os.path.dirname(segment_path), "segment_audio.m4a")
+    try:
+        clip.write_videofile(segment_path, codec='libx264', fps=RENDER_FPS, preset='ultrafast', threads=4, audio_codec='aac', audio_bitrate='128k', temp_audiofile=temp_audiofile)
+    finally:
+        # Image-based scenes do not close their audio reader themselves
+        if clip.audio:
+            clip.audio.close()
+        clip.close()
+    return segment_path
+
+
+def remove_segments(segment_paths):
+    for segment_path in segment_paths:
+        if os.path.exists(segment_path):
+            os.remove(segment_path)
+
+
+def segment_key(pipeline, scene_data, language):
+    # Voice and overlay style follow from the pipeline and the language; RENDER_PROFILE
+    # covers changes to the rendering code itself
+    return content_key(pipeline, canonical_scene_data(scene_data), language, RENDER_BACKEND, RENDER_FPS, RENDER_PROFILE)
+
+
+def render_finished(task_id):
+    # A message redelivered after its render ended must not overwrite the outcome
+    return read_task_status(task_id).get("status") in ("completed", "failed")
+
+
+def check_render_attempts(task_id):
+    # Tasks are acknowledged late: a render whose worker died is delivered again.
+    # Returns False, and fails the task, once it has been attempted too many times;
+    # also False, leaving the status alone, when the render already ended
+    if render_finished(task_id):
+        logger.debug(f"Render {task_id} already finished, ignoring its redelivery")
+        return False
+    key = f"render_attempts:{task_id}"
+    pipe = redis_client.pipeline()
+    pipe.incr(key)
+    pipe.expire(key, TASK_STATUS_TTL)
+    attempts = pipe.execute()[0]
+    if attempts > RENDER_MAX_ATTEMPTS:
+        logger.error(f"Render {task_id} interrupted {attempts - 1} times, giving up")
+        set_task_status(task_id, "failed", error="Render interrupted too many times")
+        clear_checkpoints(task_id)
+        return False
+    if attempts > 1:
+        logger.debug(f"Resuming render {task_id}, attempt {attempts}")
+        publish_progress(task_id, "resuming", attempt=attempts)
+    return True
+
+
+def load_checkpoints(task_id):
+    # Scene index -> blob of its finished segment, left by an interrupted attempt
+    data = redis_client.hgetall(f"render_checkpoints:{task_id}")
+    return {int(index): blob_name.decode() for index, blob_name in data.items()}
+
+
+def save_checkpoint(task_id, index, segment_path):
+    # Durable copy of a finished segment: the next attempt may run on another node.
+    # Best effort, a missing checkpoint only means rendering that scene again
+    try:
+        blob_name = upload_to_blob_storage(segment_path, "segment")
+        pipe = redis_client.pipeline()
+        pipe.hset(f"render_checkpoints:{task_id}", index, blob_name)
+        pipe.expire(f"render_checkpoints:{task_id}", TASK_STATUS_TTL)
+        pipe.execute()
+    except Exception as e:
+        logger.error(f"Failed to checkpoint scene {index} of {task_id}: {e}")
+
+
+def clear_checkpoints(task_id):
+    for blob_name in load_checkpoints(task_id).values():
+        delete_from_blob_storage(blob_name, SEGMENT_CONTAINER)
+    redis_client.delete(f"render_checkpoints:{task_id}")
+
+
+def render_video_from_segments(task_id, pipeline, scenes_data, prefetch, render_segment, language, music, workdir):
+    # Segment assembly: encode every scene to its own segment, then join them without decoding.
+    # Scenes found in the segment cache or checkpointed by an interrupted attempt skip
+    # their TTS, downloads and encode entirely.
+    # Returns the URL of the uploaded video
+    segment_paths = [os.path.join(scene_workspace(workdir, i), "segment.mp4") for i in range(len(scenes_data))]
+    keys = [segment_key(pipeline, scene_data, language) for scene_data in scenes_data]
+    try:
+        missing = [i for i, key in enumerate(keys) if not segment_cache.copy_to(key, segment_paths[i])]
+        logger.debug(f"{len(scenes_data) - len(missing)} of {len(scenes_data)} scenes found in the segment cache")
+
+        # Segments finished by an interrupted attempt of this task
+        checkpoints = load_checkpoints(task_id)
+        for i in [i for i in missing if i in checkpoints]:
+            download_blob(SEGMENT_CONTAINER, checkpoints[i], segment_paths[i])
+            segment_cache.put_file(keys[i], segment_paths[i])
+            missing.remove(i)
+
+        # Start the asset requests of every scene to render at once
+        scenes_assets = prefetch([scenes_data[i] for i in missing], language, os.path.join(workdir, "assets"))
+        publish_progress(task_id, "assets", 20)
+
+        for done, (i, assets) in enumerate(zip(missing, scenes_assets), 1):
+            render_segment(scenes_data[i], language, segment_paths[i], assets=assets)
+            segment_cache.put_file(keys[i], segment_paths[i])
+            save_checkpoint(task_id, i, segment_paths[i])
+            publish_progress(task_id, "scene", scene_progress(done, len(missing)), scene=i + 1, scenes=len(scenes_data))
+        publish_progress(task_id, "assembling", 85)
+        return publish_video_from_segments(segment_paths, music, workdir)
+    finally:
+        # Also runs when the render fails for good; a killed worker leaves them for the next attempt
+        clear_checkpoints(task_id)
+        remove_segments(segment_paths)
+
+
+def render_and_upload_segment(pipeline, render_segment, scene_data, language, task_id, scenes_total):
+    # Push the segment to blob storage so the assembling worker can fetch it
+    with task_workspace(f"scene-{uuid.uuid4()}") as workdir:
+        segment_path = os.path.join(workdir, "segment.mp4")
+        key = segment_key(pipeline, scene_data, language)
+        if not segment_cache.copy_to(key, segment_path):
+            render_segment(scene_data, language, segment_path)
+            segment_cache.put_file(key, segment_path)
+        segment_blob = upload_to_blob_storage(segment_path, "segment")
+    # Recorded per task: a failed chord or a redelivered scene must not leak its blob
+    pipe = redis_client.pipeline()
+    pipe.sadd(f"task_segments:{task_id}", segment_blob)
+    pipe.expire(f"task_segments:{task_id}", TASK_STATUS_TTL)
+    pipe.execute()
+    publish_scene_done(task_id, scenes_total)
+    return segment_blob
+
+
+def delete_task_segments(task_id, segment_blobs=()):
+    # Every segment blob uploaded for the task, including those of failed or retried scenes
+    key = f"task_segments:{task_id}"
+    blobs = {blob.decode() for blob in redis_client.smembers(key)} | set(segment_blobs)
+    for segment_blob in blobs:
+        delete_from_blob_storage(segment_blob, SEGMENT_CONTAINER)
+    redis_client.delete(key)
+
+
+def render_scenes_in_parallel(task_id, scene_signatures, music):
+    logger.debug(f"Fanning out {len(scene_signatures)} scenes for task {task_id}")
+    callback = assemble_video_task.s(task_id, music).on_error(render_failed_task.s(task_id))
+    chord(scene_signatures)(callback)
+
+
+@celery.task(name="assemble_video_task")
+def assemble_video_task(segment_blobs, task_id, music):
+    scenes = []
+    try:
+        if render_finished(task_id):
+            logger.debug(f"Render {task_id} already finished, ignoring its redelivery")
+            return
+        with task_workspace(task_id) as workdir:
+            logger.debug(f"Assembling {len(segment_blobs)} segments for task {task_id}")
+            publish_progress(task_id, "assembling", 85)
+            segment_paths = []
+            for i, segment_blob in enumerate(segment_blobs):
+                segment_path = os.path.join(workdir, f"segment_{i}.mp4")
+                download_blob(SEGMENT_CONTAINER, segment_blob, segment_path)
+                segment_paths.append(segment_path)
+
+            if SEGMENT_ASSEMBLY:
+                video_url = publish_video_from_segments(segment_paths, music, workdir)
+            else:
+                output_path = os.path.join(workdir, f"final_video_{uuid.uuid4()}.mp4")
+                scenes = [VideoFileClip(segment_path) for segment_path in segment_paths]
+                create_video_with_scenes(scenes, output_path, music)
+                video_url = upload_to_blob_storage(output_path, "video")
+
+        # Update task status to completed
+        set_task_status(task_id, "completed", video_url=video_url)
+        logger.debug(f"Task {task_id} marked as completed in Redis.")
+    except Exception as e:
+        logger.error(f"Error in assemble_video_task: {traceback.format_exc()}")
+        set_task_status(task_id, "failed", error=str(e))
+    finally:
+        for scene in scenes:
+            scene.close()
+        delete_task_segments(task_id, segment_blobs)
+
+
+@celery.task(name="render_failed_task")
+def render_failed_task(request, exc, tb, task_id):
+    # Error callback of the render chain and of the fan-out chord
+    logger.error(f"Rendering failed for task {task_id}: {exc}")
+    set_task_status(task_id, "failed", error=str(exc))
+    # The render may have been killed before its own cleanup ran
+    clear_checkpoints(task_id)
+    delete_task_segments(task_id)
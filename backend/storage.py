@@ -0,0 +1,126 @@
+import base64
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from azure.storage.blob import BlobServiceClient, BlobBlock, ContentSettings
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "azure")
+# Parallel block transfers for large MP4s
+STORAGE_MAX_CONCURRENCY = int(os.getenv("STORAGE_MAX_CONCURRENCY", "8"))
+STORAGE_BLOCK_SIZE = int(os.getenv("STORAGE_BLOCK_SIZE", str(4 * 1024 * 1024)))
+
+
+class AzureBlobStorage:
+    # One long-lived client per process: its HTTP session keeps the connections pooled
+
+    def __init__(self, connection_string):
+        self.connection_string = connection_string
+        self._client = None
+        self._client_pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        # Celery forks its workers: never share a connection pool with the parent
+        if self._client is None or self._client_pid != os.getpid():
+            with self._lock:
+                if self._client is None or self._client_pid != os.getpid():
+                    self._client = BlobServiceClient.from_connection_string(
+                        self.connection_string,
+                        max_single_put_size=STORAGE_BLOCK_SIZE,
+                        max_block_size=STORAGE_BLOCK_SIZE,
+                        max_single_get_size=STORAGE_BLOCK_SIZE,
+                        max_chunk_get_size=STORAGE_BLOCK_SIZE
+                    )
+                    self._client_pid = os.getpid()
+        return self._client
+
+    def blob_client(self, container_name, blob_name):
+        return self.client.get_blob_client(container=container_name, blob=blob_name)
+
+    def upload_file(self, container_name, blob_name, local_file_path):
+        # Files above one block are staged as blocks in parallel, then committed
+        with open(local_file_path, "rb") as data:
+            self.blob_client(container_name, blob_name).upload_blob(data, overwrite=True, max_concurrency=STORAGE_MAX_CONCURRENCY)
+
+    def upload_stream(self, container_name, blob_name, chunks, content_type="video/mp4"):
+        # Each chunk is staged as a block as soon as it is produced; the blob only
+        # appears when the block list is committed after the last chunk
+        blob_client = self.blob_client(container_name, blob_name)
+        block_ids = []
+        in_flight = []
+        with ThreadPoolExecutor(max_workers=STORAGE_MAX_CONCURRENCY) as executor:
+            for chunk in chunks:
+                block_id = base64.b64encode(f"{len(block_ids):08d}".encode()).decode()
+                block_ids.append(block_id)
+                in_flight.append(executor.submit(blob_client.stage_block, block_id, chunk))
+                # Bound the memory held by chunks waiting for upload
+                if len(in_flight) >= STORAGE_MAX_CONCURRENCY:
+                    in_flight.pop(0).result()
+            for future in in_flight:
+                future.result()
+        blob_client.commit_block_list([BlobBlock(block_id=block_id) for block_id in block_ids],
+                                      content_settings=ContentSettings(content_type=content_type))
+
+    def download_file(self, container_name, blob_name, download_file_path):
+        # Ranged GETs fetched in parallel straight into the file
+        with open(download_file_path, "wb") as download_file:
+            self.blob_client(container_name, blob_name).download_blob(max_concurrency=STORAGE_MAX_CONCURRENCY).readinto(download_file)
+
+    def delete(self, container_name, blob_name):
+        self.blob_client(container_name, blob_name).delete_blob()
+
+    def url(self, container_name, blob_name):
+        return self.blob_client(container_name, blob_name).url
+
+
+class LocalStorage:
+    # Same interface on a local directory, to run and benchmark without Azure
+
+    def __init__(self, root, base_url=None):
+        self.root = root
+        self.base_url = base_url
+
+    def path_for(self, container_name, blob_name):
+        return os.path.join(self.root, container_name, blob_name)
+
+    def upload_file(self, container_name, blob_name, local_file_path):
+        path = self.path_for(container_name, blob_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.part"
+        shutil.copyfile(local_file_path, temp_path)
+        os.replace(temp_path, path)
+
+    def upload_stream(self, container_name, blob_name, chunks, content_type="video/mp4"):
+        path = self.path_for(container_name, blob_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.part"
+        try:
+            with open(temp_path, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def download_file(self, container_name, blob_name, download_file_path):
+        shutil.copyfile(self.path_for(container_name, blob_name), download_file_path)
+
+    def delete(self, container_name, blob_name):
+        os.remove(self.path_for(container_name, blob_name))
+
+    def url(self, container_name, blob_name):
+        if self.base_url:
+            return f"{self.base_url.rstrip('/')}/{container_name}/{blob_name}"
+        return f"file://{os.path.abspath(self.path_for(container_name, blob_name))}"
+
+
+def make_storage():
+    if STORAGE_BACKEND == "local":
+        return LocalStorage(os.getenv("LOCAL_STORAGE_ROOT", "storage"), os.getenv("LOCAL_STORAGE_URL"))
+    return AzureBlobStorage(os.getenv("AZURE_STORAGE_CONNECTION_STRING"))
+
+
+storage = make_storage()
@@ -0,0 +1,102 @@
+import bisect
+import os
+from functools import lru_cache
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+
+SUBTITLE_FONT = os.getenv("SUBTITLE_FONT", "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf")
+# Number of phrase bitmaps kept in memory by each worker process (a 4-word phrase at
+# 40 px is about 70 KB, so the default stays well under 50 MB per process)
+SUBTITLE_CACHE_SIZE = int(os.getenv("SUBTITLE_CACHE_SIZE", "512"))
+
+
+@lru_cache(maxsize=32)
+def load_font(font, fontsize):
+    return ImageFont.truetype(font, fontsize)
+
+
+@lru_cache(maxsize=SUBTITLE_CACHE_SIZE)
+def render_phrase(text, font=SUBTITLE_FONT, fontsize=40, color='white'):
+    # Rasterize a phrase in-process with Pillow instead of spawning ImageMagick.
+    # Returns read-only (rgb, mask) uint8 arrays shared by every task of the worker.
+    pil_font = load_font(font, fontsize)
+    left, top, right, bottom = pil_font.getbbox(text)
+    width = max(right - left, 1)
+    height = max(bottom - top, 1)
+
+    image = Image.new("RGBA", (width, height), ImageColor.getrgb(color)[:3] + (0,))
+    draw = ImageDraw.Draw(image)
+    draw.text((-left, -top), text, font=pil_font, fill=color)
+
+    pixels = np.asarray(image)
+    rgb = np.ascontiguousarray(pixels[:, :, :3])
+    mask = np.ascontiguousarray(pixels[:, :, 3])
+    rgb.flags.writeable = False
+    mask.flags.writeable = False
+    return rgb, mask
+
+
+class SubtitleTrack:
+    # Phrase timings kept sorted by start time: each frame looks up and blits
+    # only the active phrase, whatever the number of phrases in the script
+
+    def __init__(self, timings, font=SUBTITLE_FONT, fontsize=40, color='white'):
+        timings = sorted(timings)
+        self.starts = [start for start, _, _ in timings]
+        self.ends = [end for _, end, _ in timings]
+        # Rendering every bitmap up front surfaces font errors before the encode starts
+        self.bitmaps = [render_phrase(text, font, fontsize, color) for _, _, text in timings]
+
+    def active_bitmap(self, t):
+        i = bisect.bisect_right(self.starts, t) - 1
+        if i < 0 or t >= self.ends[i]:
+            return None
+        return self.bitmaps[i]
+
+    def blit(self, get_frame, t):
+        frame = get_frame(t)
+        bitmap = self.active_bitmap(t)
+        if bitmap is None:
+            return frame
+        return overlay_bitmap(frame, bitmap)
+
+    def still_frames(self, background, duration):
+        # Over a static background the scene only changes when the phrase does:
+        # returns one pre-blended (frame, duration) pair per phrase or gap
+        frames = []
+        position = 0
+        for start, end, bitmap in zip(self.starts, self.ends, self.bitmaps):
+            start, end = max(start, position), min(end, duration)
+            if start > position:
+                frames.append((background, start - position))
+            if end > start:
+                frames.append((overlay_bitmap(background, bitmap), end - start))
+                position = end
+        if duration > position:
+            frames.append((background, duration - position))
+        return frames
+
+
+def overlay_bitmap(frame, bitmap):
+    rgb, mask = bitmap
+    frame_height, frame_width = frame.shape[:2]
+    height, width = mask.shape
+    # Centered, cropped to the frame when the phrase is wider than the video
+    x = (frame_width - width) // 2
+    y = (frame_height - height) // 2
+    left, top = max(x, 0), max(y, 0)
+    right, bottom = min(x + width, frame_width), min(y + height, frame_height)
+    rgb = rgb[top - y:bottom - y, left - x:right - x]
+    # Only the visible part of the mask is converted to blending weights
+    mask = mask[top - y:bottom - y, left - x:right - x, None].astype(np.float32) / 255
+
+    frame = frame.copy()
+    region = frame[top:bottom, left:right]
+    frame[top:bottom, left:right] = (rgb * mask + region * (1 - mask)).astype('uint8')
+    return frame
+
+
+def add_subtitle_track(clip, timings, fontsize=40, color='white', font=SUBTITLE_FONT):
+    # timings: list of (start, end, text) in seconds
+    track = SubtitleTrack(timings, font, fontsize, color)
+    return clip.fl(track.blit)
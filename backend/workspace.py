@@ -0,0 +1,82 @@
+import os
+import re
+import shutil
+import time
+from contextlib import contextmanager
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+
+# Scratch space of the render tasks, meant to be a tmpfs mount (see compose.yml)
+WORKSPACE_ROOT = os.getenv("WORKSPACE_ROOT", "/tmp/render")
+# Total scratch bytes allowed on this node, across every task and process
+WORKSPACE_QUOTA_BYTES = int(os.getenv("WORKSPACE_QUOTA_BYTES", str(4 * 1024 * 1024 * 1024)))
+# Workspaces older than this are swept even if their owner pid looks alive
+WORKSPACE_MAX_AGE = int(os.getenv("WORKSPACE_MAX_AGE", str(6 * 3600)))
+
+
+class WorkspaceQuotaExceeded(Exception):
+    pass
+
+
+def disk_usage(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, filename)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def sweep_stale_workspaces():
+    # Workspaces left behind by a crashed or killed worker process
+    if not os.path.isdir(WORKSPACE_ROOT):
+        return
+    now = time.time()
+    for name in os.listdir(WORKSPACE_ROOT):
+        path = os.path.join(WORKSPACE_ROOT, name)
+        match = re.match(r"^(\d+)-", name)
+        if not match:
+            continue
+        try:
+            age = now - os.stat(path).st_mtime
+        except FileNotFoundError:
+            continue
+        if not pid_alive(int(match.group(1))) or age > WORKSPACE_MAX_AGE:
+            logger.debug(f"Removing stale workspace {path}")
+            shutil.rmtree(path, ignore_errors=True)
+
+
+@contextmanager
+def task_workspace(name):
+    # Private scratch directory of one task, removed on success and on failure
+    os.makedirs(WORKSPACE_ROOT, exist_ok=True)
+    usage = disk_usage(WORKSPACE_ROOT)
+    if usage >= WORKSPACE_QUOTA_BYTES:
+        raise WorkspaceQuotaExceeded(f"Scratch space quota reached on this node ({usage} bytes used)")
+
+    # The owner pid in the name lets sweep_stale_workspaces spot orphans
+    path = os.path.join(WORKSPACE_ROOT, f"{os.getpid()}-{name}")
+    os.makedirs(path)
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def scene_workspace(workdir, index):
+    path = os.path.join(workdir, f"scene_{index}")
+    os.makedirs(path, exist_ok=True)
+    return path
@@ -4,7 +4,7 @@ import { CommonModule } from '@angular/common';
 import { HttpClient, HttpHeaders, HttpParams } from '@angular/common/http';
 import { HttpClientModule } from '@angular/common/http';
 import { of, Observable, forkJoin, interval, throwError } from 'rxjs';
-import { catchError, map, switchMap, takeWhile } from 'rxjs/operators';
+import { catchError, map, mergeMap, switchMap, takeWhile, toArray } from 'rxjs/operators';
 
 interface StoryResponse {
   complete_story: string;
@@ -78,6 +78,39 @@ export class VideoAnimationComponent {
       });
   }
 
+  // Same flow, but every image is requested as soon as its scene is generated
+  // instead of waiting for the whole story
+  mainFunctionStreaming(): void {
+    if (!this.storyTopic.trim()) {
+      this.handleError('Please enter a topic for your story.', new Error('No topic provided'));
+      return;
+    }
+    this.startLoading();
+    this.updateProgress('Generating story and images...');
+
+    this.streamStoryScenes()
+      .pipe(
+        mergeMap((scene) =>
+          this.generateImage(scene.image_prompt).pipe(
+            map((image) => ({ index: scene.index, result: [image, scene.sentences] as [string, string] }))
+          )
+        ),
+        toArray()
+      )
+      .subscribe({
+        next: (results) => {
+          this.generatedResults = results
+            .sort((a, b) => a.index - b.index)
+            .map(({ result }) => result)
+            .filter((result) => result[0] !== undefined && result[1] !== undefined);
+          console.log('Generated Results:', this.generatedResults);
+          this.incrementProgress(50);
+          this.generateVideo();
+        },
+        error: (error) => this.handleError('Failed to generate the story. Please try again later.', error),
+      });
+  }
+
   // Function to handle scene generation with error handling
   private handleSceneGeneration(scenes: Array<{ image_prompt: string; sentences: string }>) {
     const sceneRequests = scenes.map((scene, index) => {
@@ -124,7 +157,7 @@ export class VideoAnimationComponent {
       next: (response) => {
         const taskId = response.task_id;
         this.incrementProgress(25);
-        this.pollForVideoAvailability(taskId);
+        this.listenForVideoProgress(taskId);
       },
       error: (error) => {
         console.error('Error starting video generation:', error);
@@ -133,6 +166,41 @@ export class VideoAnimationComponent {
     });
   }
 
+  // Follow the render progress pushed by the server (Server-Sent Events)
+  private listenForVideoProgress(taskId: string): void {
+    const apiUrl = this.getApiUrl(`/generic_apis/task_events/${taskId}`);
+    const startProgress = this.progress;
+    const events = new EventSource(apiUrl);
+
+    events.onmessage = (message) => {
+      const event: { stage?: string, status?: string, progress?: number, scene?: number, scenes?: number, video_url?: string, error?: string } = JSON.parse(message.data);
+      if (event.status === 'completed') {
+        events.close();
+        this.video_url = event.video_url!;
+        this.updateProgress('Video generation complete.');
+        this.finishLoading();
+      } else if (event.status === 'failed') {
+        events.close();
+        console.error('Video generation failed:', event.error);
+        this.handleError('Video generation failed. Please try again later.', event.error);
+      } else {
+        if (event.progress !== undefined) {
+          // The render progress covers what is left of the bar
+          this.progress = Math.max(this.progress, startProgress + event.progress * (100 - startProgress) / 100);
+        }
+        const scene = event.scene ? ` (scene ${event.scene}/${event.scenes})` : '';
+        this.updateProgress(`Video status: ${event.stage ?? event.status}${scene}...`);
+      }
+    };
+
+    events.onerror = (error) => {
+      // Fall back to polling when the stream cannot be kept open
+      console.error('Progress stream interrupted, polling instead:', error);
+      events.close();
+      this.pollForVideoAvailability(taskId);
+    };
+  }
+
   // Poll the Azure Blob URL to check if the video is available
   private pollForVideoAvailability(taskId: string): void {
     const apiUrl = this.getApiUrl(`/generic_apis/task_status/${taskId}`);
@@ -198,6 +266,32 @@ export class VideoAnimationComponent {
     );
   }
 
+  // Scenes pushed by the server (Server-Sent Events) while the story is still being written
+  private streamStoryScenes(): Observable<{ index: number; image_prompt: string; sentences: string }> {
+    const params = new HttpParams()
+      .set('topic', this.storyTopic)
+      .set('language', this.selectedLanguage);
+    const apiUrl = this.getApiUrl(`/animated_story/get_story_stream?${params.toString()}`);
+
+    return new Observable((subscriber) => {
+      const events = new EventSource(apiUrl);
+      events.addEventListener('scene', (message) => {
+        subscriber.next(JSON.parse((message as MessageEvent).data));
+      });
+      events.addEventListener('story', (message) => {
+        const story: StoryResponse = JSON.parse((message as MessageEvent).data);
+        console.log('The Story has been generated:', story.complete_story);
+        events.close();
+        subscriber.complete();
+      });
+      events.onerror = (error) => {
+        events.close();
+        subscriber.error(error);
+      };
+      return () => events.close();
+    });
+  }
+
   generateImage(parameter: string): Observable<string | undefined> {
     const apiUrl = this.getApiUrl('/generic_apis/get_image');
     const params = new HttpParams().set('prompt', parameter);
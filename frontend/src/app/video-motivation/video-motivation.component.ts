@@ -86,7 +86,7 @@ export class VideoMotivationComponent {
       next: (response) => {
         const taskId = response.task_id;
         this.incrementProgress(25);
-        this.pollForVideoAvailability(taskId);
+        this.listenForVideoProgress(taskId);
       },
       error: (error) => {
         console.error('Error starting video generation:', error);
@@ -95,6 +95,41 @@ export class VideoMotivationComponent {
     });
   }
 
+  // Follow the render progress pushed by the server (Server-Sent Events)
+  private listenForVideoProgress(taskId: string): void {
+    const apiUrl = this.getApiUrl(`/generic_apis/task_events/${taskId}`);
+    const startProgress = this.progress;
+    const events = new EventSource(apiUrl);
+
+    events.onmessage = (message) => {
+      const event: { stage?: string, status?: string, progress?: number, scene?: number, scenes?: number, video_url?: string, error?: string } = JSON.parse(message.data);
+      if (event.status === 'completed') {
+        events.close();
+        this.video_url = event.video_url!;
+        this.updateProgress('Video generation complete.');
+        this.finishLoading();
+      } else if (event.status === 'failed') {
+        events.close();
+        console.error('Video generation failed:', event.error);
+        this.handleError('Video generation failed. Please try again later.', event.error);
+      } else {
+        if (event.progress !== undefined) {
+          // The render progress covers what is left of the bar
+          this.progress = Math.max(this.progress, startProgress + event.progress * (100 - startProgress) / 100);
+        }
+        const scene = event.scene ? ` (scene ${event.scene}/${event.scenes})` : '';
+        this.updateProgress(`Video status: ${event.stage ?? event.status}${scene}...`);
+      }
+    };
+
+    events.onerror = (error) => {
+      // Fall back to polling when the stream cannot be kept open
+      console.error('Progress stream interrupted, polling instead:', error);
+      events.close();
+      this.pollForVideoAvailability(taskId);
+    };
+  }
+
   // Poll the Azure Blob URL to check if the video is available
   private pollForVideoAvailability(taskId: string): void {
     const apiUrl = this.getApiUrl(`/generic_apis/task_status/${taskId}`);